@@ -0,0 +1,438 @@
+#
+# async_pyboard.py
+#
+# asyncio variant of pyboard.py to drive many boards from one thread
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+AsyncPyboard implements the raw REPL protocol and the file system helpers
+of pyboard.Pyboard as coroutines. All boards share the event loop instead
+of a thread each, and nothing polls: a coroutine waiting for a board is
+woken as soon as its port becomes readable.
+
+Only serial ports are supported. Boards are opened with the coroutine
+AsyncPyboard.open(), which opens the port in the loop's executor, so a
+port that's slow to open doesn't hold up the other boards, e.g.:
+
+    async def deploy(port):
+        async with await AsyncPyboard.open(port) as pyb:
+            await pyb.enter_raw_repl(soft_reset=False)
+            await pyb.fs_put("main.py", "main.py")
+            await pyb.exit_raw_repl()
+
+    async def main(ports):
+        await asyncio.gather(*(deploy(p) for p in ports))
+"""
+
+import asyncio, functools, os
+import serial
+
+from pyboard import (
+    PyboardError,
+    fs_block_line_consumer,
+    fs_encode_block,
+    fs_read_blocks_cmd,
+    fs_write_blocks_cmd,
+    fs_write_chunk_size,
+    FS_WRITE_WINDOW,
+)
+
+class AsyncSerial:
+    # A serial port whose incoming data is collected by the event loop. On
+    # posix the port is watched with loop.add_reader(). Other platforms
+    # have no selectable serial handles, so a blocking read runs in the
+    # loop's executor there instead.
+
+    def __init__(self, port):
+        # port is an open serial.Serial as returned by open()
+        self._loop = asyncio.get_running_loop()
+        self._buffer = bytearray()
+        self._event = asyncio.Event()
+        self._error = None
+        self._task = None
+        self.serial = port
+
+        if os.name == "posix":
+            self._loop.add_reader(self.serial.fd, self._on_readable)
+        else:
+            self._task = self._loop.create_task(self._read_task())
+
+    @classmethod
+    async def open(cls, device, baudrate=115200, exclusive=True):
+        # Set options, and exclusive if pyserial supports it. Opening
+        # e.g. a Bluetooth port may block for seconds, so that's done
+        # outside the event loop
+        serial_kwargs = {"baudrate": baudrate, "timeout": 0 if os.name == "posix" else None}
+        if serial.__version__ >= "3.3":
+            serial_kwargs["exclusive"] = exclusive
+        port = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(serial.Serial, device, **serial_kwargs))
+        return cls(port)
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                self.serial.cancel_read()
+            except Exception:
+                pass
+        elif self.serial.is_open:
+            self._loop.remove_reader(self.serial.fd)
+        self.serial.close()
+
+    def _received(self, data):
+        self._buffer += data
+        self._event.set()
+
+    def _failed(self, e):
+        # e.g. the device has been unplugged. Report this to the consumer
+        self._error = e
+        self._event.set()
+
+    def _on_readable(self):
+        try:
+            # the port is non-blocking, this returns what has arrived
+            self._received(self.serial.read(4096))
+        except Exception as e:
+            self._loop.remove_reader(self.serial.fd)
+            self._failed(e)
+
+    async def _read_task(self):
+        try:
+            while True:
+                data = await self._loop.run_in_executor(None, self.serial.read, 1)
+                self._received(data + self.serial.read(self.serial.in_waiting))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self._failed(e)
+
+    async def _wait(self, timeout):
+        # wait for new data, return False if the timeout expired first
+        if self._error:
+            raise serial.SerialException(str(self._error))
+        self._event.clear()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if self._error:
+            raise serial.SerialException(str(self._error))
+        return True
+
+    def _take(self, num, data_consumer=None):
+        data = bytes(self._buffer[:num])
+        del self._buffer[:num]
+        if data_consumer and data:
+            data_consumer(data)
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def flush_input(self):
+        self._buffer.clear()
+
+    async def read(self, num, timeout=10):
+        # like serial.read(), less than num bytes are returned on timeout
+        while len(self._buffer) < num:
+            if not await self._wait(timeout):
+                break
+        return self._take(min(num, len(self._buffer)))
+
+    async def read_until(self, ending, timeout=10, data_consumer=None):
+        # Return the data up to and including the ending. The timeout is
+        # restarted whenever data arrives. Nothing beyond the ending is
+        # consumed. With a data_consumer, data is handed over as it
+        # arrives and only the final chunk is returned.
+        start = 0
+        while True:
+            i = self._buffer.find(ending, start)
+            if i >= 0:
+                return self._take(i + len(ending), data_consumer)
+            if data_consumer:
+                # keep back what may be the start of the ending
+                self._take(max(0, len(self._buffer) - len(ending) + 1), data_consumer)
+            start = max(0, len(self._buffer) - len(ending) + 1)
+            if not await self._wait(timeout):
+                return self._take(len(self._buffer), data_consumer)
+
+    async def write(self, data):
+        if self._task:
+            await self._loop.run_in_executor(None, self.serial.write, data)
+            return
+
+        data = memoryview(data)
+        while data:
+            try:
+                data = data[os.write(self.serial.fd, data):]
+            except BlockingIOError:
+                # output buffer full, wait until the port becomes writable
+                writable = self._loop.create_future()
+                self._loop.add_writer(self.serial.fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self.serial.fd)
+
+class AsyncPyboard:
+    def __init__(self, port):
+        # port is an AsyncSerial, use open() to get a board by its device
+        self.in_raw_repl = False
+        self.use_raw_paste = True
+        self.raw_paste_window = 128  # updated once the device reported its window
+        self.serial = port
+
+    @classmethod
+    async def open(cls, device, baudrate=115200, exclusive=True):
+        try:
+            return cls(await AsyncSerial.open(device, baudrate, exclusive))
+        except (OSError, IOError):
+            raise PyboardError("failed to access " + device)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.serial.close()
+
+    async def read_until(self, ending, timeout=10, data_consumer=None):
+        return await self.serial.read_until(ending, timeout, data_consumer)
+
+    async def enter_raw_repl(self, soft_reset=True):
+        await self.serial.write(b"\r\x03\x03")  # ctrl-C twice: interrupt any running program
+
+        # flush input, give the device a moment to stop sending first
+        await asyncio.sleep(0.01)
+        self.serial.flush_input()
+
+        await self.serial.write(b"\r\x01")  # ctrl-A: enter raw REPL
+
+        if soft_reset:
+            data = await self.read_until(b"raw REPL; CTRL-B to exit\r\n>", timeout=1)
+            if not data.endswith(b"raw REPL; CTRL-B to exit\r\n>"):
+                raise PyboardError("could not enter raw repl")
+
+            await self.serial.write(b"\x04")  # ctrl-D: soft reset
+
+            data = await self.read_until(b"soft reboot\r\n")
+            if not data.endswith(b"soft reboot\r\n"):
+                raise PyboardError("could not enter raw repl")
+
+        data = await self.read_until(b"raw REPL; CTRL-B to exit\r\n")
+        if not data.endswith(b"raw REPL; CTRL-B to exit\r\n"):
+            raise PyboardError("could not enter raw repl")
+
+        self.in_raw_repl = True
+
+    async def exit_raw_repl(self):
+        await self.serial.write(b"\r\x02")  # ctrl-B: enter friendly REPL
+        self.in_raw_repl = False
+
+    async def follow(self, timeout, data_consumer=None):
+        # wait for normal output
+        data = await self.read_until(b"\x04", timeout=timeout, data_consumer=data_consumer)
+        if not data.endswith(b"\x04"):
+            raise PyboardError("timeout waiting for first EOF reception")
+        data = data[:-1]
+
+        # wait for error output
+        data_err = await self.read_until(b"\x04", timeout=timeout)
+        if not data_err.endswith(b"\x04"):
+            raise PyboardError("timeout waiting for second EOF reception")
+        data_err = data_err[:-1]
+
+        # return normal and error output
+        return data, data_err
+
+    async def raw_paste_write(self, command_bytes):
+        # Read initial header, with window size.
+        data = await self.serial.read(2)
+        if len(data) != 2:
+            raise PyboardError("timeout waiting for raw paste header")
+        window_size = data[0] | data[1] << 8
+        window_remain = window_size
+        self.raw_paste_window = window_size
+
+        # Write out the command_bytes data.
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or self.serial.in_waiting:
+                data = await self.serial.read(1)
+                if data == b"\x01":
+                    # Device indicated that a new window of data can be sent.
+                    window_remain += window_size
+                elif data == b"\x04":
+                    # Device indicated abrupt end.  Acknowledge it and finish.
+                    await self.serial.write(b"\x04")
+                    return
+                else:
+                    # Unexpected data from device.
+                    raise PyboardError("unexpected read during raw paste: {}".format(data))
+            # Send out as much data as possible that fits within the allowed window.
+            b = command_bytes[i : min(i + window_remain, len(command_bytes))]
+            await self.serial.write(b)
+            window_remain -= len(b)
+            i += len(b)
+
+        # Indicate end of data.
+        await self.serial.write(b"\x04")
+
+        # Wait for device to acknowledge end of data.
+        data = await self.read_until(b"\x04")
+        if not data.endswith(b"\x04"):
+            raise PyboardError("could not complete raw paste: {}".format(data))
+
+    async def exec_raw_no_follow(self, command):
+        if isinstance(command, bytes):
+            command_bytes = command
+        else:
+            command_bytes = bytes(command, encoding="utf8")
+
+        # check we have a prompt
+        data = await self.read_until(b">")
+        if not data.endswith(b">"):
+            raise PyboardError("could not enter raw repl")
+
+        if self.use_raw_paste:
+            # Try to enter raw-paste mode.
+            await self.serial.write(b"\x05A\x01")
+            data = await self.serial.read(2)
+            if data == b"R\x00":
+                # Device understood raw-paste command but doesn't support it.
+                pass
+            elif data == b"R\x01":
+                # Device supports raw-paste mode, write out the command using this mode.
+                return await self.raw_paste_write(command_bytes)
+            else:
+                # Device doesn't support raw-paste, fall back to normal raw REPL.
+                data = await self.read_until(b"w REPL; CTRL-B to exit\r\n>")
+                if not data.endswith(b"w REPL; CTRL-B to exit\r\n>"):
+                    raise PyboardError("could not enter raw repl")
+            # Don't try to use raw-paste mode again for this connection.
+            self.use_raw_paste = False
+
+        # Write command using standard raw REPL, 256 bytes every 10ms.
+        for i in range(0, len(command_bytes), 256):
+            await self.serial.write(command_bytes[i : min(i + 256, len(command_bytes))])
+            await asyncio.sleep(0.01)
+        await self.serial.write(b"\x04")
+
+        # check if we could exec command
+        data = await self.serial.read(2)
+        if data != b"OK":
+            raise PyboardError("could not exec command (response: %r)" % data)
+
+    async def exec_raw(self, command, timeout=10, data_consumer=None):
+        await self.exec_raw_no_follow(command)
+        return await self.follow(timeout, data_consumer)
+
+    async def eval(self, expression):
+        ret = await self.exec_("print({})".format(expression))
+        return ret.strip()
+
+    async def exec_(self, command, data_consumer=None):
+        ret, ret_err = await self.exec_raw(command, data_consumer=data_consumer)
+        if ret_err:
+            raise PyboardError("exception", ret, ret_err)
+
+        return ret
+
+    async def execfile(self, filename):
+        with open(filename, "rb") as f:
+            pyfile = f.read()
+        return await self.exec_(pyfile)
+
+    async def fs_ls(self, src):
+        # returns the listing instead of printing it as output of
+        # many boards would otherwise be interleaved
+        cmd = (
+            "import uos\nfor f in uos.ilistdir(%s):\n"
+            " print('{:12} {}{}'.format(f[3]if len(f)>3 else 0,f[0],'/'if f[1]&0x4000 else ''))"
+            % (("'%s'" % src) if src else "")
+        )
+        return await self.exec_(cmd)
+
+    async def fs_read_blocks(self, src, block_consumer, chunk_size=512):
+        await self.exec_(fs_read_blocks_cmd(src, chunk_size),
+                         data_consumer=fs_block_line_consumer(block_consumer))
+
+    async def fs_get(self, src, dest, chunk_size=512):
+        with open(dest, "wb") as f:
+            await self.fs_read_blocks(src, f.write, chunk_size)
+
+    async def fs_wait_ack(self):
+        # wait for the receiver of fs_write_blocks to acknowledge a block
+        data = await self.serial.read(1)
+        if data == b"\x01":
+            return
+        if data == b"\x04":
+            # Receiver has stopped, probably due to an exception. Fetch its
+            # error output and report it like exec_() does.
+            data_err = await self.read_until(b"\x04")
+            # let the raw REPL discard lines sent meanwhile
+            await self.serial.write(b"\x01")
+            await self.read_until(b"raw REPL; CTRL-B to exit\r\n", timeout=1)
+            raise PyboardError("exception", b"", data_err[:-1])
+        if not data:
+            raise PyboardError("fs_put: timeout waiting for acknowledge")
+        raise PyboardError("fs_put: unexpected read during transfer: {}".format(data))
+
+    async def fs_write_blocks(self, dest, data, progress=None, window=2, cmd=None):
+        # same protocol as Pyboard.fs_write_blocks()
+        await self.exec_raw_no_follow(cmd or fs_write_blocks_cmd(dest))
+        await self.fs_wait_ack()
+        chunk_size = fs_write_chunk_size(
+            (self.raw_paste_window if self.use_raw_paste else FS_WRITE_WINDOW) // window)
+
+        data = memoryview(data)
+        in_flight = 0
+        for i in range(0, len(data), chunk_size):
+            while in_flight >= window or (in_flight and self.serial.in_waiting):
+                await self.fs_wait_ack()
+                in_flight -= 1
+            await self.serial.write(fs_encode_block(data[i : i + chunk_size]))
+            in_flight += 1
+            if progress:
+                progress(min(i + chunk_size, len(data)))
+
+        while in_flight:
+            await self.fs_wait_ack()
+            in_flight -= 1
+
+        # an empty line ends the transfer
+        await self.serial.write(b"\n")
+        ret, ret_err = await self.follow(10)
+        if ret_err:
+            raise PyboardError("exception", ret, ret_err)
+
+    async def fs_put(self, src, dest):
+        with open(src, "rb") as f:
+            await self.fs_write_blocks(dest, f.read())
+
+    async def fs_mkdir(self, dir):
+        await self.exec_("import uos\nuos.mkdir('%s')" % dir)
+
+    async def fs_rmdir(self, dir):
+        await self.exec_("import uos\nuos.rmdir('%s')" % dir)
+
+    async def fs_rm(self, src):
+        await self.exec_("import uos\nuos.remove('%s')" % src)
@@ -0,0 +1,177 @@
+#
+# backup.py - write files downloaded from the board into a zip archive
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os, time, threading, zipfile, shutil, json
+from queue import Queue, Empty
+
+# Every backup archive contains a manifest with the size, the sha256
+# and, if the board has a clock, the modification time of each file.
+# Later backups only read files from the board which have changed
+MANIFEST = ".upide-manifest.json"
+
+def read_manifest(archive):
+   # return the files recorded in an archive's manifest or None
+   try:
+      return json.loads(archive.read(MANIFEST).decode("utf-8"))["files"]
+   except (KeyError, ValueError):
+      return None
+
+def manifest_data(files, base = None):
+   manifest = { "version": 1, "files": files }
+   if base: manifest["base"] = base
+   return json.dumps(manifest, indent=1).encode("utf-8")
+
+class BackupWriter:
+   # Blocks are written to the archive entry as they are received, so
+   # a file never has to be kept in memory as a whole. With threaded
+   # set the compression runs in a thread of its own and overlaps with
+   # the transfer of the following blocks
+
+   # files of these types are compressed already and are just stored
+   STORED_TYPES = ( ".zip", ".gz", ".tgz", ".bz2", ".xz", ".jpg", ".jpeg",
+                    ".png", ".gif", ".webp", ".mp3", ".ogg", ".mp4" )
+
+   QUEUE_SIZE = 256   # blocks waiting for the compression thread
+
+   def __init__(self, archive, threaded = False):
+      self.archive = archive
+      self.entry = None
+      self.error = None
+      self.thread = None
+      if threaded:
+         self.queue = Queue(self.QUEUE_SIZE)
+         self.thread = threading.Thread(target=self.run, daemon=True)
+         self.thread.start()
+
+   def run(self):
+      while True:
+         op = self.queue.get()
+         if op is None: break
+
+         # everything after an error is dropped. It's reported to the
+         # downloading side with its next request
+         if not self.error:
+            try:
+               self.do(*op)
+            except Exception as e:
+               self.error = e
+
+   def do(self, op, arg = None):
+      if op == "open":
+         if os.path.splitext(arg)[1].lower() in self.STORED_TYPES:
+            info = zipfile.ZipInfo(arg, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            self.entry = self.archive.open(info, "w")
+         else:
+            # uses the archive's compression and level
+            self.entry = self.archive.open(arg, "w")
+      elif op == "write":
+         self.entry.write(arg)
+      elif op == "close":
+         self.entry.close()
+         self.entry = None
+      elif op == "copy":
+         # take an entry from another archive
+         name, source = arg
+         self.do("open", name)
+         with source.open(name) as f:
+            shutil.copyfileobj(f, self.entry)
+         self.do("close")
+
+   def request(self, op, arg = None):
+      if not self.thread:
+         self.do(op, arg)
+         return
+
+      if self.error: raise self.error
+      self.queue.put( ( op, arg ) )
+
+   def open(self, name):
+      # start a new entry without leading slash
+      self.request("open", name[1:] if name.startswith("/") else name)
+
+   def write(self, data):
+      self.request("write", bytes(data))
+
+   def close(self):
+      self.request("close")
+
+   def copy(self, name, source):
+      self.request("copy", ( name[1:] if name.startswith("/") else name, source ))
+
+   def add(self, name, data):
+      self.open(name)
+      self.write(data)
+      self.close()
+
+   def finish(self):
+      # wait for the compression thread. An entry left open by a failed
+      # download is closed, so the archive itself can be closed
+      if self.thread:
+         self.queue.put(None)
+         self.thread.join()
+         self.thread = None
+
+      if self.entry:
+         try:
+            self.entry.close()
+         except Exception:
+            pass
+         self.entry = None
+
+      if self.error: raise self.error
+
+class RestoreReader:
+   # A thread decompresses the files of an archive ahead of their upload
+   # into a bounded queue, so the serial transfer doesn't have to wait
+   # for the archive and at most a few files are kept in memory
+
+   QUEUE_SIZE = 4   # files decompressed ahead
+
+   def __init__(self, archive, names):
+      self.archive = archive
+      self.names = names
+      self.queue = Queue(self.QUEUE_SIZE)
+      self.cancelled = threading.Event()
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+
+   def run(self):
+      try:
+         for name in self.names:
+            if self.cancelled.is_set(): return
+            self.queue.put( ( name, self.archive.read(name) ) )
+      except Exception as e:
+         # handed to the uploading side in place of the file
+         self.queue.put(e)
+
+   def __iter__(self):
+      for _ in self.names:
+         item = self.queue.get()
+         if isinstance(item, Exception): raise item
+         yield item
+
+   def close(self):
+      # stop reading ahead, e.g. after a failed upload. The thread may
+      # be blocked on the full queue, so that's emptied until it ends
+      self.cancelled.set()
+      while self.thread.is_alive():
+         try:
+            self.queue.get(timeout=0.1)
+         except Empty:
+            pass
@@ -18,15 +18,70 @@
 
 from PyQt5.QtCore import *
 
-import pyboard, serial, sys
+import pyboard, serial, os
+from filecache import FileCache
+from backup import BackupWriter, RestoreReader, read_manifest, manifest_data, MANIFEST
 import serial.tools.list_ports
 import time
 
 import threading
-import binascii
-from queue import Queue
+import hashlib
+import itertools
+from queue import Queue, PriorityQueue, Empty
 import ast
 
+class Job:
+   # a command waiting for or being processed by the worker thread. Several
+   # requests may be coalesced into one job, so there's a list of callbacks
+   def __init__(self, priority, func, args, cb, key=None):
+      self.priority = priority
+      self.func = func
+      self.args = args
+      self.callbacks = [ cb ]
+      self.key = key
+
+def local_files(local, remote):
+   # return a dict of all files in the host directory local by their
+   # path below the board directory remote and a list of all directories.
+   # Hidden files and python caches are skipped
+   files, dirs = { }, [ ]
+   for root, dirnames, filenames in os.walk(local):
+      dirnames[:] = sorted(d for d in dirnames if not d.startswith(".") and d != "__pycache__")
+      path = os.path.relpath(root, local).replace(os.sep, "/")
+      path = remote if path == "." else remote + "/" + path
+      dirs.extend(path + "/" + d for d in dirnames)
+      for f in filenames:
+         if not f.startswith("."):
+            files[path + "/" + f] = os.path.join(root, f)
+   return files, dirs
+
+def local_hash(path):
+   # sha256 of a host file, read in blocks
+   h = hashlib.sha256()
+   with open(path, "rb") as f:
+      for block in iter(lambda: f.read(65536), b""):
+         h.update(block)
+   return h.hexdigest()
+
+def code_mkdirs(paths):
+   # device code creating the directories in the given order. Existing
+   # directories are fine
+   return (
+      "import os\nfor p in {0!r}:\n"
+      " try:os.mkdir(p)\n"
+      " except OSError:\n"
+      "  if not os.stat(p)[0]&0x4000:raise\n".format(paths))
+
+def parent_dirs(names):
+   # all directories the given files are in, parents first
+   dirs = [ ]
+   for name in names:
+      parts = name.split("/")[1:-1]
+      for i in range(len(parts)):
+         path = "/" + "/".join(parts[:i+1])
+         if path not in dirs: dirs.append(path)
+   return dirs
+
 class Board(QObject):
    code_downloaded = pyqtSignal()  # callback when code has been downloaded but not yet run
    console = pyqtSignal(bytes)     # data has arrived from console output
@@ -34,7 +89,10 @@ class Board(QObject):
    error = pyqtSignal(str, str)
    status = pyqtSignal(str)
    lost = pyqtSignal()
+   reconnected = pyqtSignal(str)   # board has been reset and is connected again at that port
    interactive = pyqtSignal()
+   entries = pyqtSignal(str, list) # entries of a directory being listed
+   wakeup = pyqtSignal()           # internal: messages from the worker are waiting
    
    # commands
    SCAN = 1
@@ -45,18 +103,78 @@ class Board(QObject):
    RUN = 6
    REPL = 7
    CONNECT = 8    # on user request with noscan
+   BATCH = 9      # several file system operations in one raw repl session
+   SYNC = 10      # make a board directory match a directory on the PC
+   BACKUP = 11    # download files into a zip archive
+   RESTORE = 12   # upload all files of a zip archive
+
+   # command priorities, lower values are processed first. A command
+   # which is already running is not interrupted by a more urgent one
+   PRIO_INTERACTIVE = 0
+   PRIO_NORMAL = 1
+
+   # A port has that many seconds to answer a probe. The port a board
+   # was found at last time is probed alone for the head start time
+   PROBE_TIMEOUT = 1
+   PROBE_HEAD_START = 0.3
 
+   # A board which has been reset or replugged gets that many seconds
+   # to show up again. An idle connection is checked every second
+   RECONNECT_TIMEOUT = 10
+   RECONNECT_INTERVAL = 0.2
+   WATCH_INTERVAL = 1
+
+   # USB vendor ids of MicroPython boards and of the usb serial
+   # converters they commonly use
+   USB_VIDS = {
+      0xf055,  # MicroPython (pyboard)
+      0x2e8a,  # Raspberry Pi (Pico)
+      0x303a,  # Espressif native USB
+      0x10c4,  # Silicon Labs CP210x
+      0x1a86,  # WCH CH340
+      0x0403,  # FTDI
+      0x239a,  # Adafruit
+      0x0694,  # LEGO
+      0x0483,  # STMicroelectronics
+      0x0d28,  # ARM DAPLink (micro:bit)
+   }
+
+   # console output is collected and forwarded once there's this
+   # much of it or once the oldest part is that many ms old
+   CONSOLE_CHUNK = 4096
+   CONSOLE_DELAY = 20
+   
    def __init__(self, parent=None):
       super().__init__(parent)
       self.board = None  # not connected yet
-      self.worker_thread = None
+      self.device_id = None  # usb vid, pid and serial number of the board
       self.queue = Queue()
       self.interact = False
+      self.cache = FileCache()
+      self.known = { }   # hash and size of files whose contents are in the cache
+
+      # Commands are queued and processed one after the other by a
+      # persistent worker thread. The lock is held while the board is
+      # being talked to, so close() can't pull the port from under it
+      self.jobs = PriorityQueue()
+      self.job_counter = itertools.count()  # keeps the order within a priority
+      self.job = None         # job being processed by the worker
+      self.pending = { }      # jobs which may be joined by identical requests
+      self.lock = threading.RLock()
+      self.closing = threading.Event()  # stops a reconnect while closing
+      self.worker_thread = threading.Thread(target=self.worker, daemon=True)
+      self.worker_thread.start()
+
+      # The worker wakes up the gui thread through a queued signal when it
+      # posts a message and no wakeup is pending already
+      self.wakeup_pending = threading.Event()
+      self.wakeup.connect(self.on_wakeup, Qt.QueuedConnection)
 
-      # start a timer for frequent event queue polling
-      self.timer = QTimer()
-      self.timer.timeout.connect(self.on_timer)
-      self.timer.start(20)  # poll at 50 Hz
+      self.console_data = bytearray()
+      self.console_time = 0
+      self.console_timer = QTimer()
+      self.console_timer.setSingleShot(True)
+      self.console_timer.timeout.connect(self.flush_console)
 
       self.soft_reset = False  # disable by default, may be enabled if no LEGO device is detected
 
@@ -66,31 +184,151 @@ class Board(QObject):
       # self.soft_reset = mode
       pass
       
+   def post(self, msg):
+      self.queue.put(msg)
+      if not self.wakeup_pending.is_set():
+         self.wakeup_pending.set()
+         self.wakeup.emit()
+
    def send_console(self, str):
-      self.queue.put( ( "console",  str ) )
+      self.post( ( "console",  str ) )
       
    def send_status(self, msg):
-      self.queue.put( ( "status", msg ) )
+      self.post( ( "status", msg ) )
        
    def send_progress(self, val):
-      self.queue.put( ( "progress", val ) )
+      self.post( ( "progress", val ) )
        
    def send_result(self, success, res=None):       
-      self.queue.put( ( "result", ( success, res ) ) )
-      
-   def func_probe_all(self, ports):
-      for port in ports:
-         self.send_status(self.tr("Checking port {}").format(port.device))
-         res = self.probe(port.device)
-         if res:
-            self.board = res
-            self.send_result( True, res.serial.port )
+      self.post( ( "result", self.job, ( success, res ) ) )
+      
+   def func_probe_all(self, ports, fast=False):
+      # All ports are probed in parallel and the first board answering
+      # is used. With fast set the first port, where a board was found
+      # last time, gets a head start, so the other ports usually don't
+      # even have to be opened
+      found = threading.Event()
+      claim = threading.Lock()
+      results = Queue()
+
+      def probe(port):
+         board = self.probe(port.device, found)
+         with claim:
+            # another board may have answered at the same time
+            if board and found.is_set():
+               board.close()
+               board = None
+            elif board:
+               found.set()
+         results.put( (port, board) )
+
+      def start(ports):
+         for port in ports:
+            self.send_status(self.tr("Checking port {}").format(port.device))
+            threading.Thread(target=probe, args=(port,), daemon=True).start()
+         return len(ports)
+
+      if fast:
+         running, rest, timeout = start(ports[:1]), ports[1:], Board.PROBE_HEAD_START
+      else:
+         running, rest, timeout = start(ports), [ ], Board.PROBE_TIMEOUT * 2
+
+      while running:
+         try:
+            port, board = results.get(timeout=timeout)
+         except Empty:
+            # a probe stuck e.g. while opening its port is given up
+            if not rest: break
+         else:
+            running -= 1
+            if board:
+               self.set_board(board, port)
+               self.send_result( True, board.serial.port )
+
+               # the remaining probes give up now. Wait for them to
+               # release their ports
+               try:
+                  for i in range(running):
+                     results.get(timeout=Board.PROBE_TIMEOUT)
+               except Empty:
+                  pass
+               return
+
+         # head start is over or the first port has failed
+         if rest:
+            running += start(rest)
+            rest, timeout = [ ], Board.PROBE_TIMEOUT * 2
+
+      # no board found in time. A probe still running mustn't claim its
+      # board from now on. One which has claimed it already is used
+      with claim:
+         found.set()
+      while True:
+         try:
+            port, board = results.get_nowait()
+         except Empty:
+            break
+         if board:
+            self.set_board(board, port)
+            self.send_result( True, board.serial.port )
             return
 
-      # no board found at all
       self.send_result(False)
       
-   def probe(self, device):
+   def set_board(self, board, port=None):
+      # remember what identifies the board's usb device, so it can
+      # be found again after a reset
+      self.board = board
+      self.device_id = None
+      self.closing.clear()
+      if port and port.vid is not None:
+         self.device_id = ( port.vid, port.pid, port.serial_number )
+
+   def same_device(self, port, device):
+      if self.device_id:
+         return self.device_id == ( port.vid, port.pid, port.serial_number )
+      return port.device == device
+
+   def connection_lost(self):
+      # make sure we call the super class to trigger hardware
+      # problems. The buffered serial would just report its buffer
+      try:
+         serial.Serial.inWaiting(self.board.serial)
+      except Exception:
+         return True
+      return False
+
+   def reconnect(self):
+      # The board has been reset or replugged. Wait for the same usb
+      # device to show up again, possibly at a different port, and
+      # reopen it
+      device = self.board.serial.port
+      try:
+         self.board.close()
+      except Exception:
+         pass
+      self.board = None
+      self.send_status(self.tr("Connection to board lost, reconnecting ..."))
+
+      # close() stops waiting for the board, so it doesn't have to wait
+      # for the port to be given up
+      deadline = time.monotonic() + Board.RECONNECT_TIMEOUT
+      while time.monotonic() < deadline and not self.closing.is_set():
+         ports = [ p for p in serial.tools.list_ports.comports() if self.same_device(p, device) ]
+         ports.sort(key = lambda p: p.device != device)
+         for port in ports:
+            board = self.probe(port.device, self.closing)
+            if board and self.closing.is_set():
+               board.close()
+            elif board:
+               self.board = board
+               self.post( ("reconnected", board.serial.port) )
+               return True
+         self.closing.wait(Board.RECONNECT_INTERVAL)
+
+      return False
+
+   def probe(self, device, cancel=None):
       try:
          # start a probe thread with timeout            
          board = pyboard.Pyboard(device)
@@ -105,61 +343,154 @@ class Board(QObject):
       board.serial.timeout = 1
         
       try:
-         board.enter_raw_repl(self.soft_reset)
-      except Exception as e:
-         try:
-            board.enter_raw_repl(self.soft_reset)
-         except Exception as e:
+         if not self.handshake(board, cancel):
             board.close()
             return None
+         if self.soft_reset:
+            board.enter_raw_repl(True)
+      except Exception as e:
+         board.close()
+         return None
 
       board.exit_raw_repl()
+
+      # from now on let a background thread drain the serial port
+      if hasattr(board.serial, "start_reader"):
+         board.serial.start_reader()
       return board
 
-   def func_wrapper(self, *args):
+   def handshake(self, board, cancel=None):
+      # Interrupt any running program and request the raw REPL. Devices
+      # which don't send the raw REPL prompt in time are rejected, even
+      # if they keep sending other data. The request is repeated once, as
+      # a busy program may miss the first interrupt
+      prompt = b"raw REPL; CTRL-B to exit\r\n>"
+      start = time.monotonic()
+      retry = True
+      data = bytearray()
+      board.serial.write(b"\r\x03\x03\r\x01")
+      while True:
+         if cancel and cancel.is_set():
+            return False
+
+         elapsed = time.monotonic() - start
+         if elapsed > Board.PROBE_TIMEOUT:
+            return False
+         if retry and elapsed > Board.PROBE_TIMEOUT / 2:
+            board.serial.write(b"\r\x03\x03\r\x01")
+            retry = False
+         
+         n = board.serial.inWaiting()
+         if n:
+            data += board.serial.read(n)
+            if prompt in data:
+               board.in_raw_repl = True
+               return True
+            # only the end may be the beginning of the prompt
+            del data[:-len(prompt)]
+         elif hasattr(board.serial, "wait"):
+            board.serial.wait(0.02)
+         else:
+            time.sleep(0.01)
+
+   def func_wrapper(self, func, args, retry=True):
       try:
-         # args is a tuple of function and another tuple with its arguments
-         args[0](*args[1])
+         func(*args)
       except Exception as e:
          print("Exception", str(e))
          
          # something has failed. check if the serial connection is lost
-         try:
-            # make sure we call the super class to trigger
-            # hardware problems
-            self.board.serial.super().inWaiting()
-         except:
-            # port seems to be lost
-            self.queue.put( ("lost",) )
-            return
+         if self.board and self.connection_lost():
+            if not self.reconnect():
+               # port seems to be lost for good
+               if not self.closing.is_set(): self.post( ("lost",) )
+               return
+
+            # requests which only read from the board are just repeated
+            if retry and self.job.key:
+               self.func_wrapper(func, args, False)
+               return
+
+            e = self.tr("The board has been reset")
+
+         # an exception raised on the board is reported with its traceback
+         elif isinstance(e, pyboard.PyboardError) and len(e.args) == 3 and e.args[0] == "exception":
+            e = e.args[2].decode("utf-8", "replace")
 
          if not str(e): e = "Unknown exception"
          
          # must have been something else. Just report it
-         self.queue.put( ("exception", ("", str(e) )))
+         self.post( ("exception", ("", str(e) )))
          self.send_result(False)         
             
-   def do_in_thread(self, func, args=None):
-      """ run worker thread in the background to do the board
-      communication """
-      
-      # Check if thread is already active. This should
-      # never happen
-      if self.worker_thread:
-         raise Exception("Worker already running")
+   def worker(self):
+      while True:
+         try:
+            self.job = self.jobs.get(timeout=Board.WATCH_INTERVAL)[2]
+         except Empty:
+            # notice the reset of an idle board right away
+            with self.lock:
+               if self.board and self.connection_lost() and not self.reconnect() \
+                  and not self.closing.is_set():
+                  self.post( ("lost",) )
+            continue
 
-      # start worker thread to do the actual job ...
-      self.worker_thread = threading.Thread(target=self.func_wrapper, args=(func,args if args else tuple()))
+         with self.lock:
+            self.func_wrapper(self.job.func, self.job.args)
+         self.job = None
+         
+   def do_in_thread(self, func, args=None, cb=None, priority=PRIO_NORMAL, key=None):
+      """ queue a command for the worker thread which does the board
+      communication in the background. cb is invoked with the result """
 
-      self.worker_thread.start()
-      
-   def on_timer(self):
-      # frequently poll the worker queue for results
+      # Only requests which just read from the board have a key. A request
+      # identical to a pending one is added to it. Any other request may
+      # change the board's state, so nothing queued before it may be
+      # joined afterwards
+      if key in self.pending:
+         self.pending[key].callbacks.append(cb)
+         return
+      if not key: self.pending.clear()
+
+      job = Job(priority, func, args if args else tuple(), cb, key)
+      if key: self.pending[key] = job
+      self.jobs.put( (priority, next(self.job_counter), job) )
 
-      console_data = b""
+   def clear_jobs(self):
+      # drop all commands which have not been started yet
+      self.pending.clear()
+      while not self.jobs.empty():
+         self.jobs.get()
+      
+   def flush_console(self):
+      # forward accumulated serial data to the console
+      self.console_timer.stop()
+      if self.console_data:
+         data = bytes(self.console_data)
+         self.console_data.clear()
+         self.console.emit(data)
+         
+   def on_wakeup(self):
+      # process the messages the worker has posted. The flag is cleared
+      # first, so messages posted from now on trigger another wakeup
+      self.wakeup_pending.clear()
+      
       while not self.queue.empty():
          msg = self.queue.get()
 
+         if msg[0] == "console":
+            # console output may happen pretty fast. Writing single bytes
+            # to the output will slow things down pretty much. So we
+            # collect data and forward it in larger chunks.
+            if not self.console_data:
+               self.console_time = time.monotonic()
+            self.console_data += msg[1]
+            continue
+
+         # output pending console data, so it isn't delayed after
+         # e.g. the exception output
+         self.flush_console()
+
          # message from worker thread to be displayed in the status bar
          if msg[0] == "status":
             self.status.emit(msg[1])
@@ -168,20 +499,11 @@ class Board(QObject):
             self.progress.emit(msg[1])
             
          if msg[0] == "exception":
-            # output pending console data, so it isn't delayed
-            # after the exception output
-            if console_data:
-               self.console.emit(console_data)
-               console_data = b""
-            
             self.error.emit(msg[1][0], msg[1][1])
-            
-         if msg[0] == "console":
-            # console output may happen pretty fast. Writing single bytes
-            # to the output will slow things down pretty much. So we
-            # collect data and return the whole message.
-            console_data += msg[1]
 
+         if msg[0] == "entries":
+            self.entries.emit(msg[1], msg[2])
+            
          if msg[0] == "downloaded":
             self.code_downloaded.emit()
             
@@ -189,38 +511,48 @@ class Board(QObject):
             self.interactive.emit()
             
          if msg[0] == "lost":
-            self.worker_thread = None
+            self.pending.clear()   # these will never get a result
             self.lost.emit()
+
+         if msg[0] == "reconnected":
+            self.reconnected.emit(msg[1])
             
          # check if the command has sent a result ...
          if msg[0] == "result":
-            # invoke callback if present
-            self.worker_thread = None
-            if self.cb: self.cb(msg[1][0], msg[1][1])
-
-      # forward accumulated serial data to the console
-      if console_data:
-         self.console.emit(console_data)
+            job, ( success, res ) = msg[1], msg[2]
+            if self.pending.get(job.key) is job:
+               del self.pending[job.key]
+            # invoke callbacks if present
+            for cb in job.callbacks:
+               if cb: cb(success, res)
 
-   def scan(self, port = None):
-      ports = serial.tools.list_ports.comports()
+      # forward console data once enough has been collected or it's
+      # getting old. Otherwise wait a little for more to arrive
+      if self.console_data:
+         age = 1000 * (time.monotonic() - self.console_time)
+         if len(self.console_data) >= Board.CONSOLE_CHUNK or age >= Board.CONSOLE_DELAY:
+            self.flush_console()
+         elif not self.console_timer.isActive():
+            self.console_timer.start(int(Board.CONSOLE_DELAY - age) + 1)
 
-      # if the given port is in the list, then move it
-      # to the begin of the list to probe it first
+   @staticmethod
+   def likely_port(port):
+      # Bluetooth serial ports are never MicroPython boards. Opening
+      # them may even take seconds
+      return port.vid is not None or not "bluetooth" in (
+         port.device + " " + str(port.description)).lower()
 
-      # check if port is in list of port devices and prepend it
-      ports_sorted = [ ]
-      for p in ports:
-         if port == p.device:
-            ports_sorted.append(p)
+   def scan(self, port = None, cb = None):
+      ports = [ p for p in serial.tools.list_ports.comports()
+                if p.device == port or Board.likely_port(p) ]
 
-      # append all other devices
-      for p in ports:
-         if port != p.device:
-            ports_sorted.append(p)
+      # the port that was successful on a previous run is probed first,
+      # followed by the USB devices commonly used with MicroPython
+      ports.sort(key = lambda p: (p.device != port, p.vid not in Board.USB_VIDS))
 
       # probe all ports in background thread
-      self.do_in_thread(self.func_probe_all, ( ports_sorted, ))
+      fast = len(ports) > 1 and ports[0].device == port
+      self.do_in_thread(self.func_probe_all, ( ports, fast ), cb)
       
    def reply_handle_line_ast(self, line = None):
       if line != None:
@@ -275,8 +607,8 @@ class Board(QObject):
                    "'machine': o.machine }\r"
              "print(v)")
 
-   def version(self):
-      self.do_in_thread(self.func_version)
+   def version(self, cb = None):
+      self.do_in_thread(self.func_version, cb=cb)
 
    def func(self, cmd):
       self.reply_parser()           # reset parser
@@ -305,79 +637,222 @@ class Board(QObject):
          "_list('')\n"
       )
 
-   def ls(self):
-      self.do_in_thread(self.func_ls)
+   def exec_literals(self, cmd, consumer=None):
+      # run code which prints one line of parsable python per result. The
+      # results are passed to the consumer in lists as they arrive and
+      # are returned at the end
+      results = [ ]
+      pending = bytearray()
+      def on_data(data):
+         pending.extend(data)
+         lines = pending.split(b"\n")
+         pending[:] = lines.pop()
+         new = [ ast.literal_eval(l.decode("utf-8")) for l in
+                 ( l.strip(b"\r\x04") for l in lines ) if l ]
+         if new:
+            results.extend(new)
+            if consumer: consumer(new)
 
-   def func_get(self, src, size, reply_parms, chunk_size=256):
-      self.reply_parser()           # reset parser
+      self.board.exec_(cmd, data_consumer=on_data)
+      return results
+      
+   def func_ls_dir(self, path):
+      # list a single directory. Entries are posted as they arrive, so
+      # the file view can fill in while the listing is still running
+      self.board.enter_raw_repl(self.soft_reset)
+      entries = self.exec_literals(
+         "import uos\n"
+         "for f in uos.ilistdir({}):\n"
+         " print(repr((f[0],None if f[1]&0x4000 else f[3] if len(f)>3 else 0)))\n"
+         .format(repr(path if path else "/")),
+         lambda new: self.post( ( "entries", path, new ) ))
+      self.board.exit_raw_repl()
+      self.send_result(True, entries)
+      
+   def ls(self, path = None, cb = None):
+      # without a path the whole file system is listed recursively
+      if path is None:
+         self.do_in_thread(self.func_ls, cb=cb, key=("ls",))
+      else:
+         self.do_in_thread(self.func_ls_dir, (path,), cb, key=("ls", path))
+
+   # device code of a function returning the sha256 of a file as hex
+   CODE_HASH = (
+        "import uhashlib,ubinascii\n"
+        "b=bytearray(512)\n"
+        "m=memoryview(b)\n"
+        "def _h(p):\n"
+        " h=uhashlib.sha256()\n"
+        " with open(p,'rb') as f:\n"
+        "  while 1:\n"
+        "   n=f.readinto(b)\n"
+        "   if not n:break\n"
+        "   h.update(m[:n])\n"
+        " return ubinascii.hexlify(h.digest()).decode()\n")
+
+   def code_sha256(self, filename):
+      return Board.CODE_HASH + "print(_h('{0}'))\n".format(filename)
+
+   def code_hashes(self, filenames):
+      # print a (name, hash) tuple for each file
+      return Board.CODE_HASH + "for p in {0!r}:\n print(repr((p,_h(p))))\n".format(filenames)
+   
+   def func_get(self, src, size, cache=False, chunk_size=512):
       self.board.enter_raw_repl(self.soft_reset)
 
-      self.board.exec_("f=open('%s','rb')\nr=f.read" % src)
-      result = bytearray()
-      while True:
-         data = bytearray()
-         self.board.exec_("print(r(%u))" % chunk_size, data_consumer=lambda d: data.extend(d))
-         assert data.endswith(b"\r\n\x04")
+      # With the cache enabled, the board first calculates the file's
+      # hash. The file itself is then only read if it's not in the cache
+      digest = None
+      if cache:
          try:
-            data = ast.literal_eval(str(data[:-3], "ascii"))
-            if not isinstance(data, bytes):
-               raise ValueError("Not bytes")
-         except (UnicodeError, ValueError) as e:
-            raise pyboard.PyboardError("fs_get: Could not interpret received data: %s" % str(e))
-         if not data:
-            break
-         
-         result += data
-         self.send_progress(100 * len(result) // size)
+            digest = self.board.exec_(self.code_sha256(src)).decode("utf-8").strip()
+         except pyboard.PyboardError:
+            # e.g. no uhashlib.sha256 on this board
+            pass
+
+         data = self.cache.get(digest, size) if digest else None
+         if data is not None:
+            self.known[src] = ( digest, size )
+            self.board.exit_raw_repl()
+            self.send_result(True, data)
+            return
 
-      self.board.exec_("f.close()")
+      # the whole file is streamed in one exec and decoded block by block
+      result = bytearray()
+      def on_block(data):
+         result.extend(data)
+         if size: self.send_progress(min(100, 100 * len(result) // size))
+
+      self.board.fs_read_blocks(src, on_block, chunk_size)
       
       self.board.exit_raw_repl()
-      reply_parms["code"] = result   # add data read to reply
-      self.send_result(True, reply_parms )
+      if digest and self.cache.put(digest, bytes(result)):
+         self.known[src] = ( digest, len(result) )
+      self.send_result(True, result)
       
-   def get(self, name, size, reply_parms):
+   def get(self, name, size, reply_parms, cb = None):
       self.progress.emit(0)
       if not "quiet" in reply_parms:
          self.status.emit(self.tr("Reading {}".format(name.split("/")[-1])))
-      self.do_in_thread(self.func_get, ( name, size, reply_parms ) )
+
+      # all parms are returned with the callback so the receiving side knows
+      # what to do with it. Each request gets its own parms as several
+      # requests for the same file may be served by a single read
+      def reply(success, res):
+         if success: reply_parms["code"] = res   # add data read to reply
+         if cb: cb(success, reply_parms if success else res)
+         
+      # the file cache is used if requested by "cache": True
+      self.do_in_thread(self.func_get, ( name, size, reply_parms.get("cache", False) ),
+                        reply, key=("get", name))
        
-   def func_put(self, all_data, dest, chunk_size=256):
-      self.reply_parser()           # reset parser
-      self.board.enter_raw_repl(self.soft_reset)
-      size = len(all_data)
-      sent = 0
+   def delta_range(self, old, new):
+      # return the lengths of the common head and tail of two files
+      n = min(len(old), len(new))
+      head = 0
+      while head + 4096 <= n and old[head:head+4096] == new[head:head+4096]:
+         head += 4096
+      while head < n and old[head] == new[head]:
+         head += 1
+
+      n -= head
+      tail = 0
+      while tail + 4096 <= n and old[len(old)-tail-4096:len(old)-tail] == new[len(new)-tail-4096:len(new)-tail]:
+         tail += 4096
+      while tail < n and old[len(old)-tail-1] == new[len(new)-tail-1]:
+         tail += 1
+         
+      return head, tail
+
+   def code_copy(self, src):
+      # device code opening src as s with a function to copy n bytes from
+      # it to another file
+      return (
+        "import os\n"
+        "def cp(d,n):\n"
+        " b=bytearray(256)\n"
+        " m=memoryview(b)\n"
+        " while n:\n"
+        "  k=s.readinto(m[:min(n,256)])\n"
+        "  if not k:break\n"
+        "  d.write(m[:k])\n"
+        "  n-=k\n"
+        "s=open('{0}','rb')\n").format(src)
+   
+   def put_delta(self, data, dest, progress):
+      # Only write the part of the file which differs from the contents
+      # known to be on the board. Returns False if that isn't possible
+      known = self.known.get(dest)
+      old = self.cache.get(*known) if known else None
+      if old is None:
+         return False
+
+      try:
+         # make sure the file hasn't been changed otherwise in the meantime
+         if self.board.exec_(self.code_sha256(dest)).decode("utf-8").strip() != known[0]:
+            return False
       
-      self.board.exec_("f=open('%s','wb')\nw=f.write" % dest)
-      while True:
-         if all_data != None and len(all_data) > chunk_size:
-            data = all_data[0:chunk_size]
-            all_data = all_data[chunk_size:]
-         else:
-            data = all_data
-            all_data = None
+         head, tail = self.delta_range(old, data)
+         if head == len(old) == len(data):
+            return True   # nothing has changed
          
-         if not data: break
-         self.board.exec_("w(" + repr(data) + ")")
-         sent += len(data)
+         if len(old) == len(data):
+            # patch the file in place
+            cmd = pyboard.fs_write_blocks_cmd(dest, "r+b", head=" f.seek({})\n".format(head))
+         else:
+            # write a new file from the unchanged head and tail of the old
+            # one and the changed part in between. Then replace the old one
+            tmp = dest + ".upide.tmp"
+            cmd = pyboard.fs_write_blocks_cmd(tmp, "wb", self.code_copy(dest),
+               " cp(f,{})\n".format(head),
+               " s.seek({})\n cp(f,{})\n".format(len(old) - tail, tail),
+               "s.close()\nos.remove('{0}')\nos.rename('{1}','{0}')\n".format(dest, tmp))
+            
+         self.board.fs_write_blocks(dest, memoryview(data)[head:len(data)-tail],
+                                    lambda sent: progress(head + sent), cmd=cmd)
+      except pyboard.PyboardError as e:
+         print("Delta write failed:", str(e))
+         return False
+
+      return True
+      
+   def func_put(self, all_data, dest, delta=False):
+      self.board.enter_raw_repl(self.soft_reset)
+
+      # the editor gives the code as text
+      if isinstance(all_data, str):
+         all_data = all_data.encode("utf-8")
+      size = len(all_data)
+
+      # the data is streamed to a receiver running on the board
+      def on_progress(sent):
          self.send_progress(100 * sent // size)
-      self.board.exec_("f.close()")
+
+      # with "delta" only the modified part is written if possible
+      if not delta or not self.put_delta(all_data, dest, on_progress):
+         self.board.fs_write_blocks(dest, all_data, on_progress)
 
       self.board.exit_raw_repl()
+
+      # remember the contents, so the next save can be a delta
+      digest = hashlib.sha256(all_data).hexdigest()
+      if self.cache.put(digest, all_data):
+         self.known[dest] = ( digest, size )
+      
       self.status.emit("")     # clear status 
       self.send_result(True)   # TOOD: add parms
        
-   def put(self, data, name):
+   def put(self, data, name, delta = False, cb = None):
       self.progress.emit(0)
       self.status.emit(self.tr("Writing {}".format(name.split("/")[-1])))
-      self.do_in_thread(self.func_put, ( data, name ))
+      self.do_in_thread(self.func_put, ( data, name, delta ), cb)
 
    def func_run(self, name, code):
       self.reply_parser()           # reset parser
       self.board.enter_raw_repl(self.soft_reset)
       
       self.board.exec_raw_no_follow(code)
-      self.queue.put( ( "downloaded", ) )
+      self.post( ( "downloaded", ) )
       report_exception = None
       
       try:
@@ -387,7 +862,7 @@ class Board(QObject):
       except Exception as e:
          # host side reported an exception
          ret_err = str(e)
-         self.queue.put( ( "exception", (name, "Internal exception:\n" + ret_err) ) )
+         self.post( ( "exception", (name, "Internal exception:\n" + ret_err) ) )
          
       self.board.exit_raw_repl()
       self.send_result(not ret_err, None)
@@ -398,10 +873,10 @@ class Board(QObject):
       # is not possible while the thread dealing with the code execution
       # is still running
       if report_exception:
-         self.queue.put( ( "exception", (name, report_exception) ) )
+         self.post( ( "exception", (name, report_exception) ) )
       
-   def run(self, name, code):
-      self.do_in_thread(self.func_run, ( name, code ))
+   def run(self, name, code, cb = None):
+      self.do_in_thread(self.func_run, ( name, code ), cb, Board.PRIO_INTERACTIVE)
       
    def stop(self):
       if self.interact:
@@ -417,27 +892,25 @@ class Board(QObject):
    def forceStop(self):
       self.board._interrupt = True
       
-   def replDo(self, cmd):
+   def func_exec(self, cmd):
       self.board.enter_raw_repl(self.soft_reset)
       self.board.exec_(cmd)
       self.board.exit_raw_repl()
+      self.send_result(True)
       
-   def rm(self, filename):
-      """Remove the specified file or directory."""
-      self.replDo( (
+   def code_rm(self, filename):
+      return (
         "import os\n"
         "try:\n"
         " os.remove('{0}')\n"
         "except:\n"
-        " os.rmdir('{0}')\n").format(filename))
-           
-   def mkdir(self, filename):
-      """Crete a directory."""
-      self.replDo( "import os\nos.mkdir('{0}')\n".format(filename) )
+        " os.rmdir('{0}')\n").format(filename)
 
-   def rename(self, old, new):
-      """Rename the specified file or directory. Copy it if renaming fails"""
-      self.replDo( (
+   def code_mkdir(self, filename):
+      return "import os\nos.mkdir('{0}')\n".format(filename)
+
+   def code_rename(self, old, new):
+      return (
         "import os\n"
         "try:\n" 
         " os.rename('{0}', '{1}')\n" 
@@ -448,8 +921,276 @@ class Board(QObject):
         "   if not buffer:\n" 
         "    break\n" 
         "   dst.write(buffer)\n" 
-        " os.remove('{4}')\n" ).format(old, new, old, new, old))
+        " os.remove('{4}')\n" ).format(old, new, old, new, old)
+      
+   def rm(self, filename, cb = None):
+      """Remove the specified file or directory."""
+      self.do_in_thread(self.func_exec, (self.code_rm(filename),), cb)
+           
+   def mkdir(self, filename, cb = None):
+      """Crete a directory."""
+      self.do_in_thread(self.func_exec, (self.code_mkdir(filename),), cb)
+
+   def rename(self, old, new, cb = None):
+      """Rename the specified file or directory. Copy it if renaming fails"""
+      self.do_in_thread(self.func_exec, (self.code_rename(old, new),), cb)
+
+   def func_batch(self, ops):
+      # run all operations in a single raw repl session. The result is a list
+      # with one entry per operation which holds the data for "get" and
+      # None for everything else
+      self.board.enter_raw_repl(self.soft_reset)
+
+      results = [ ]
+      for i, op in enumerate(ops):
+         self.send_progress(100 * i // len(ops))
+         
+         if op[0] == "get":
+            self.send_status(self.tr("Reading {}").format(op[1].split("/")[-1]))
+            data = bytearray()
+            self.board.fs_read_blocks(op[1], data.extend)
+            results.append(data)
+            continue
+         
+         if op[0] == "put":
+            self.send_status(self.tr("Writing {}").format(op[1].split("/")[-1]))
+            # the data may also be given as a callable, so it only needs
+            # to be loaded once it is actually being written
+            data = op[2]() if callable(op[2]) else op[2]
+            self.board.fs_write_blocks(op[1], data)
+         elif op[0] == "mkdir":
+            self.board.exec_(self.code_mkdir(op[1]))
+         elif op[0] == "rm":
+            self.board.exec_(self.code_rm(op[1]))
+         elif op[0] == "rename":
+            self.board.exec_(self.code_rename(op[1], op[2]))
+         else:
+            raise ValueError("Unknown batch operation {}".format(op[0]))
+         
+         results.append(None)
+
+      self.board.exit_raw_repl()
+      self.send_status("")
+      self.send_result(True, results)
+
+   def batch(self, ops, cb = None):
+      """Run a list of operations like ("put", name, data), ("get", name),
+      ("mkdir", name), ("rm", name) or ("rename", old, new)."""
+      self.progress.emit(0)
+      self.do_in_thread(self.func_batch, (ops,), cb)
 
+   def func_sync(self, local, remote, delete):
+      # Make the board directory remote match the host directory local in
+      # a single raw repl session. Only new files and those which differ
+      # in size or hash are written
+      files, dirs = local_files(local, remote)
+      self.board.enter_raw_repl(self.soft_reset)
+
+      self.send_status(self.tr("Comparing files ..."))
+      board = dict(self.exec_literals(
+         "import uos\n"
+         "def _l(d):\n"
+         " for f in uos.ilistdir(d if d else '/'):\n"
+         "  p=d+'/'+f[0]\n"
+         "  if f[1]&0x4000:\n"
+         "   print(repr((p,None)))\n"
+         "   _l(p)\n"
+         "  else:print(repr((p,f[3] if len(f)>3 else 0)))\n"
+         "try:_l({0!r})\n"
+         "except OSError:pass\n".format(remote)))
+
+      # files of the same size are compared by hash. If the board can't
+      # calculate hashes they are all written
+      same_size = [ f for f in files if board.get(f) == os.path.getsize(files[f]) ]
+      hashes = self.file_hashes(same_size) if same_size else { }
+      writes = [ f for f in sorted(files)
+                 if f not in hashes or local_hash(files[f]) != hashes[f] ]
+
+      # create missing directories, parents first. The listing doesn't
+      # include remote and its parents, so these may exist already
+      parts = remote.split("/")
+      mkdirs = [ "/".join(parts[:i+1]) for i in range(1, len(parts)) ] + dirs
+      mkdirs = [ d for d in mkdirs if d not in board ]
+      if mkdirs:
+         self.board.exec_(code_mkdirs(mkdirs))
+         
+      # files are only loaded once they are being written
+      for i, f in enumerate(writes):
+         self.send_progress(100 * i // len(writes))
+         self.send_status(self.tr("Writing {}").format(f.split("/")[-1]))
+         with open(files[f], "rb") as fd:
+            self.board.fs_write_blocks(f, fd.read())
+      
+      # remove anything not present on the host, deepest entries first
+      removes = [ ]
+      if delete:
+         removes = sorted(( p for p in board if p not in files and p not in dirs ),
+                          key = lambda p: p.count("/"), reverse = True)
+      if removes:
+         self.send_status(self.tr("Deleting files ..."))
+         self.board.exec_(
+            "import os\nfor p in {0!r}:\n"
+            " try:os.remove(p)\n"
+            " except OSError:os.rmdir(p)\n".format(removes))
+
+      self.board.exit_raw_repl()
+      self.send_status("")
+      self.send_result(True, { "written": len(writes), "deleted": len(removes),
+                               "unchanged": len(files) - len(writes),
+                               "files": { f: files[f] for f in writes } })
+
+   def sync(self, local, remote, delete = False, cb = None):
+      self.progress.emit(0)
+      self.do_in_thread(self.func_sync, ( local, remote, delete ), cb)
+      
+   def func_backup(self, files, archive, threaded, previous = None):
+      # All files are read in one raw repl session. Each block is passed
+      # on to the archive as soon as it has arrived. Files which haven't
+      # changed since a previous backup are copied from its archive
+      writer = BackupWriter(archive, threaded)
+      manifest = { }
+      try:
+         self.board.enter_raw_repl(self.soft_reset)
+         # the board is only walked again for an incremental backup. A
+         # full one is based on the listing the gui already has
+         mtimes, unchanged = { }, { }
+         if previous:
+            self.send_status(self.tr("Comparing files ..."))
+            mtimes = self.file_mtimes()
+            unchanged = self.unchanged_files(files, previous)
+
+         total = max(1, sum(size for name, size in files if not name in unchanged))
+         done = 0
+         percent = 0
+         for name, size in files:
+            if name in unchanged:
+               writer.copy(name, previous)
+               manifest[name] = { "size": size, "sha256": unchanged[name] }
+            else:
+               self.send_status(self.tr("Backing up: ")+name.split("/")[-1])
+               writer.open(name)
+               h = hashlib.sha256()
+               received = 0
+               def on_block(data):
+                  nonlocal done, percent, received
+                  writer.write(data)
+                  h.update(data)
+                  received += len(data)
+                  done += len(data)
+                  if 100 * done // total != percent:
+                     percent = 100 * done // total
+                     self.send_progress(min(100, percent))
+
+               self.board.fs_read_blocks(name, on_block)
+               writer.close()
+               manifest[name] = { "size": received, "sha256": h.hexdigest() }
+
+            if name in mtimes:
+               manifest[name]["mtime"] = mtimes[name]
+         self.board.exit_raw_repl()
+
+         writer.add(MANIFEST, manifest_data(manifest,
+                    os.path.basename(previous.filename) if previous else None))
+      except Exception:
+         try:
+            writer.finish()
+         except Exception:
+            pass
+         raise
+
+      writer.finish()
+      self.send_result(True, { "read": len(files) - len(unchanged), "unchanged": len(unchanged) })
+
+   def file_mtimes(self):
+      # modification times of all files. They are meaningless if the
+      # board has no real time clock, but are recorded anyway. Full
+      # backups don't record them
+      try:
+         return dict(self.exec_literals(
+            "import uos\n"
+            "def _l(d):\n"
+            " for f in uos.ilistdir(d if d else '/'):\n"
+            "  p=d+'/'+f[0]\n"
+            "  if f[1]&0x4000:_l(p)\n"
+            "  else:print(repr((p,uos.stat(p)[8])))\n"
+            "_l('')\n"))
+      except pyboard.PyboardError:
+         return { }
+
+   def unchanged_files(self, files, previous):
+      # Return the hashes of the files which are contained unchanged in
+      # the previous archive. Only files of the same size are hashed by
+      # the board
+      old = read_manifest(previous) or { }
+      names = set(previous.namelist())
+      same = [ n for n, s in files if n in old and old[n]["size"] == s and n.lstrip("/") in names ]
+      hashes = self.file_hashes(same)
+      return { n: h for n, h in hashes.items() if h == old[n]["sha256"] }
+
+   def file_hashes(self, names):
+      # sha256 of the given files on the board, a hundred per exec to
+      # keep the board's memory usage low. Boards without uhashlib.sha256
+      # return no hashes at all
+      hashes = { }
+      try:
+         for i in range(0, len(names), 100):
+            hashes.update(self.exec_literals(self.code_hashes(names[i:i+100])))
+      except pyboard.PyboardError:
+         return { }
+      return hashes
+
+   def backup(self, files, archive, threaded = False, previous = None, cb = None):
+      self.progress.emit(0)
+      self.do_in_thread(self.func_backup, ( files, archive, threaded, previous ), cb)
+
+   def func_restore(self, archive, existing = None):
+      # Write all files of the archive in one raw repl session. They are
+      # decompressed by a thread of their own while the previous ones are
+      # being uploaded. With the sizes of the files existing on the board
+      # given, those which are identical already are skipped
+      names = [ n for n in archive.namelist() if not n.endswith("/") and n != MANIFEST ]
+      reader = RestoreReader(archive, names)
+      try:
+         self.board.enter_raw_repl(self.soft_reset)
+
+         # all directories are created in one go, including empty ones
+         dests = [ "/" + n.lstrip("/") for n in names ]
+         empty = [ "/" + n.strip("/") + "/" for n in archive.namelist()
+                   if n.endswith("/") and n.strip("/") ]
+         dirs = parent_dirs(dests + empty)
+         if dirs:
+            self.board.exec_(code_mkdirs(dirs))
+
+         hashes = { }
+         if existing:
+            self.send_status(self.tr("Comparing files ..."))
+            hashes = self.file_hashes([ d for n, d in zip(names, dests)
+                                        if existing.get(d) == archive.getinfo(n).file_size ])
+
+         total = max(1, sum(archive.getinfo(n).file_size for n in names))
+         done = 0
+         unchanged = 0
+         for (name, data), dest in zip(reader, dests):
+            if dest in hashes and hashlib.sha256(data).hexdigest() == hashes[dest]:
+               unchanged += 1
+            else:
+               self.send_status(self.tr("Writing {}").format(dest.split("/")[-1]))
+               self.board.fs_write_blocks(dest, data,
+                  lambda sent: self.send_progress(min(100, 100 * (done + sent) // total)))
+            done += len(data)
+            self.send_progress(min(100, 100 * done // total))
+
+         self.board.exit_raw_repl()
+      finally:
+         reader.close()
+
+      self.send_status("")
+      self.send_result(True, { "written": len(names) - unchanged, "unchanged": unchanged })
+
+   def restore(self, archive, existing = None, cb = None):
+      self.progress.emit(0)
+      self.do_in_thread(self.func_restore, ( archive, existing ), cb)
+      
    def func_interactive(self):
       # try to interrupt the board
       self.board.serial.write(b"\r\x03")      
@@ -466,7 +1207,7 @@ class Board(QObject):
       data = self.board.read_until(1, b"\r\n>>> ")
       if data.endswith(b"\r\n>>> "):
          self.interact = True
-         self.queue.put( ( "interactive", True ) )  # tell console that we are now interactive
+         self.post( ( "interactive", True ) )  # tell console that we are now interactive
 
          # cut any leading newlines
          while data.startswith(b"\r\n"):
@@ -478,52 +1219,68 @@ class Board(QObject):
             num = self.board.serial.inWaiting()
             if num > 0:
                self.send_console(self.board.serial.read(num))
-            time.sleep(0.01)
+            elif hasattr(self.board.serial, "wait"):
+               # sleep until data arrives, but check for the end of interaction now and then
+               self.board.serial.wait(0.1)
+            else:
+               time.sleep(0.01)
       else:
          raise RuntimeError(self.tr("Failed to enter repl"))
 
       self.send_result(True)
       
-   def start_interactive(self):
-      self.do_in_thread(self.func_interactive)
+   def start_interactive(self, cb = None):
+      self.do_in_thread(self.func_interactive, cb=cb, priority=Board.PRIO_INTERACTIVE)
 
    def func_connect(self, port):
-      self.board = self.probe(port)
-      self.send_result(self.board != None)
+      board = self.probe(port)
+      if board:
+         self.set_board(board, next((p for p in serial.tools.list_ports.comports()
+                                     if p.device == port), None))
+      self.send_result(board != None)
       
-   def connect(self, port):
-      self.do_in_thread(self.func_connect, (port,))
+   def connect(self, port, cb = None):
+      self.do_in_thread(self.func_connect, (port,), cb)
       
    def cmd(self, cmd, cb, parms = None):
       self.progress.emit(-1)
 
-      self.cb = cb   # save callback for later usage
-      
       if cmd == Board.SCAN:
-         self.scan(parms["port"] if parms and "port" in parms else None)
+         self.scan(parms["port"] if parms and "port" in parms else None, cb)
       
       elif cmd == Board.GET_VERSION:         
-         self.version()
+         self.version(cb)
 
       elif cmd == Board.LISTDIR:
-         self.ls()
+         self.ls(parms["path"] if parms and "path" in parms else None, cb)
 
       elif cmd == Board.GET_FILE:
-         # all parms are returned with the callback so the receiving
-         # side knows what to do with it
-         self.get(parms["name"], parms["size"], parms)
+         self.get(parms["name"], parms["size"], parms, cb)
          
       elif cmd == Board.PUT_FILE:
-         self.put(parms["code"], parms["name"])
+         self.put(parms["code"], parms["name"], parms.get("delta", False), cb)
 
       elif cmd == Board.RUN:
-         self.run(parms["name"], parms["code"])
+         self.run(parms["name"], parms["code"], cb)
 
       elif cmd == Board.REPL:
-         self.start_interactive()
+         self.start_interactive(cb)
          
       elif cmd == Board.CONNECT:
-         self.connect(parms)
+         self.connect(parms, cb)
+
+      elif cmd == Board.BATCH:
+         self.batch(parms, cb)
+
+      elif cmd == Board.SYNC:
+         self.sync(parms["local"], parms["remote"], parms.get("delete", False), cb)
+
+      elif cmd == Board.BACKUP:
+         self.backup(parms["files"], parms["archive"], parms.get("threaded", False),
+                     parms.get("previous"), cb)
+
+      elif cmd == Board.RESTORE:
+         self.restore(parms["archive"], parms.get("existing"), cb)
          
    def getPort(self):
       try:
@@ -541,13 +1298,18 @@ class Board(QObject):
          self.interact = False
          time.sleep(.1)
          
-      # kill any running thread
-      if self.worker_thread:
-         try:
-            self.worker_thread.join(10)
-         except:
-            pass
+      # drop queued commands and wait for the running one to finish. A
+      # reconnect in progress is given up
+      self.clear_jobs()
+      self.closing.set()
+      if not self.lock.acquire(timeout=10):
+         # the worker still uses the port, so it's left alone
+         return
 
+      # the worker mustn't take the closed port for a reset board
       if self.board:
          self.board.close()
          self.board = None
+
+      self.closing.clear()
+      self.lock.release()
@@ -19,44 +19,214 @@
 #
 
 import serial
+import os, select, threading
 
 __version__ = serial.__version__
 
 class Serial(serial.Serial):
+    # Incoming data is kept in a preallocated bytearray between a read
+    # (head) and a write (tail) index. Consuming data just advances the
+    # head. The pending data is only moved back to the start of the buffer
+    # once the tail reaches its end, so the buffer is never re-sliced.
+    BUFFER_SIZE = 65536
+
+    # the background reader stops reading once this much data is pending
+    READER_LIMIT = 1024 * 1024
+
     def __init__(self, device, **kwargs):
+      self._buffer = bytearray(self.BUFFER_SIZE)
+      self._head = 0
+      self._tail = 0
+      self._cond = threading.Condition()
+      self._received = 0     # total number of bytes received
+      self._seen = 0         # value of _received when data was last consumed
+      self._reader = None
+      self._reader_error = None
       super().__init__(device, **kwargs)
-      self._buffer = b""
-      
+
+    def start_reader(self):
+        # Start a thread which blocks on the OS read and fills the buffer.
+        # The device's FIFO is then drained continuously and consumers are
+        # woken up through a condition variable as soon as data arrives
+        if not self._reader:
+            self._reader = threading.Thread(target=self._read_thread, daemon=True)
+            self._reader.start()
+
+    def stop_reader(self):
+        reader, self._reader = self._reader, None
+        if reader:
+            with self._cond:
+                self._cond.notify_all()
+            try:
+                self.cancel_read()
+            except Exception:
+                pass
+            reader.join(1)
+
+    def close(self):
+        self.stop_reader()
+        super().close()
+
+    def _read_thread(self):
+        try:
+            while self._reader:
+                data = super().read(max(1, super().in_waiting))
+                with self._cond:
+                    while self._reader and self._buffered() >= self.READER_LIMIT:
+                        self._cond.wait()
+                    self._append(data)
+                    self._cond.notify_all()
+        except Exception as e:
+            # e.g. the device has been unplugged. Report this to the consumer
+            with self._cond:
+                self._reader_error = e
+                self._cond.notify_all()
+
+    def _check_reader(self):
+        if self._reader_error:
+            raise serial.SerialException(str(self._reader_error))
+        
+    def _buffered(self):
+        return self._tail - self._head
+
+    def _append(self, data):
+        if self._tail + len(data) > len(self._buffer):
+            # move pending data to the start of the buffer and grow it
+            # if it's still too small
+            pending = self._buffered()
+            self._buffer[:pending] = self._buffer[self._head:self._tail]
+            self._head, self._tail = 0, pending
+            if pending + len(data) > len(self._buffer):
+                self._buffer.extend(bytes(pending + len(data) - len(self._buffer)))
+        self._buffer[self._tail:self._tail + len(data)] = data
+        self._tail += len(data)
+        self._received += len(data)
+
+    def _fill(self):
+        # buffer everything the OS has already received. With the reader
+        # thread running this has already happened
+        if self._reader:
+            self._check_reader()
+            return
+        
+        available = super().in_waiting
+        if available:
+            self._append(super().read(available))
+
+    def _block(self, num):
+        # wait until num bytes are buffered or the timeout expires
+        if not self._reader:
+            self._append(super().read(num - self._buffered()))
+            return
+
+        self._cond.wait_for(lambda: self._buffered() >= num or self._reader_error,
+                            self.timeout)
+        self._check_reader()
+            
+    def _consume(self, num):
+        self._head += num
+        if self._head == self._tail:
+            self._head = self._tail = 0
+        self._seen = self._received
+        if self._reader:
+            # the reader may be waiting for space
+            self._cond.notify_all()
+
+    def _take(self, num):
+        with memoryview(self._buffer) as view:
+            data = bytes(view[self._head:self._head + num])
+        self._consume(num)
+        return data
+
     def inWaiting(self):
         # return anything in buffer, avoid calling super().inWaiting()
         # as it is the culprit for the slow performance
-        if len(self._buffer):
-            return len(self._buffer)
+        with self._cond:
+            if self._buffered():
+                return self._buffered()
+
+            if self._reader:
+                self._check_reader()
+                return 0
         
         return super().inWaiting()
 
-    def read(self, num):
-        # check if buffer can already satisfy request
-        if len(self._buffer) >= num:
-            retval = self._buffer[:num]
-            self._buffer = self._buffer[num:]
-            return retval
-        
-        # otherwise buffer everything available
-        available = super().inWaiting()
-        if available:
-            self._buffer += super().read(available)
+    def wait(self, timeout):
+        # block until new data arrives from the device or the timeout
+        # expires. Data which is already buffered is not taken into account
+        if self._reader:
+            with self._cond:
+                return self._cond.wait_for(
+                   lambda: self._received != self._seen or self._reader_error, timeout)
+            
+        if os.name == "posix":
+            return bool(select.select([self.fd], [], [], timeout)[0])
 
-        # check if buffer is now sufficient
-        if len(self._buffer) >= num:
-            retval = self._buffer[:num]
-            self._buffer = self._buffer[num:]
-            return retval
+        # other platforms use a blocking read with a temporary timeout
+        saved_timeout = self.timeout
+        self.timeout = timeout
+        try:
+            data = super().read(1)
+        finally:
+            self.timeout = saved_timeout
+        with self._cond:
+            self._append(data)
+        return len(data) > 0
 
-        # nah, still not enough data, append more even if
-        # that might block ...
-        data = self._buffer + super().read(num - len(self._buffer))
+    def peek(self, num=None):
+        # return received data without consuming it
+        with self._cond:
+            self._fill()
+            if num is None or num > self._buffered():
+                num = self._buffered()
+            self._seen = self._received
+            with memoryview(self._buffer) as view:
+                return bytes(view[self._head:self._head + num])
 
-        # we'll return all data read, so buffer is now empty
-        self._buffer = b""     
-        return data
+    def read_until(self, expected=serial.LF, size=None):
+        # Return the data received so far up to and including "expected"
+        # without blocking. If "expected" has not been received yet, a
+        # trailing partial match is kept back. The data returned thus
+        # never extends beyond the terminator.
+        with self._cond:
+            self._fill()
+            i = self._buffer.find(expected, self._head, self._tail)
+            if i >= 0:
+                end = i + len(expected)
+            else:
+                end = self._tail
+                for k in range(min(len(expected) - 1, self._buffered()), 0, -1):
+                    if self._buffer[self._tail - k:self._tail] == expected[:k]:
+                        end = self._tail - k
+                        break
+            if size is not None:
+                end = min(end, self._head + size)
+            return self._take(end - self._head)
+
+    def readinto(self, b):
+        # like read(len(b)) but copy directly into the given buffer
+        with self._cond, memoryview(b) as target:
+            target = target.cast("B")
+            if self._buffered() < len(target):
+                self._fill()
+            if self._buffered() < len(target):
+                self._block(len(target))
+            num = min(len(target), self._buffered())
+            with memoryview(self._buffer) as view:
+                target[:num] = view[self._head:self._head + num]
+            self._consume(num)
+        return num
+
+    def read(self, num):
+        with self._cond:
+            # check if buffer can already satisfy request
+            if self._buffered() < num:
+                # otherwise buffer everything available
+                self._fill()
+
+            # nah, still not enough data, wait for more even if
+            # that might block ...
+            if self._buffered() < num:
+                self._block(num)
+
+            return self._take(min(num, self._buffered()))
@@ -24,12 +24,18 @@ from PyQt5.QtCore import *
 class Console(QPlainTextEdit):
     input = pyqtSignal(str)
     interact = pyqtSignal(bool)
+
+    # the console keeps that many lines. Older ones are dropped, so a
+    # program printing for hours doesn't fill up memory
+    MAX_LINES = 10000
     
     def __init__(self):
         super().__init__()
 
         self.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        self.setMaximumBlockCount(Console.MAX_LINES)
         self.setReadOnly(True)
+        self.log = None
         self.input_enabled = False
         
         font = QFont("Mono", 10)
@@ -52,6 +58,23 @@ class Console(QPlainTextEdit):
 
         self.savedCursor = None
 
+    def set_max_lines(self, lines):
+        # 0 keeps everything
+        self.setMaximumBlockCount(lines)
+
+    def set_log(self, filename):
+        # everything received is also appended to this file, including
+        # the lines dropped from the console
+        if self.log:
+            self.log.close()
+            self.log = None
+
+        if filename:
+            try:
+                self.log = open(filename, "ab")
+            except OSError as e:
+                print("Cannot open console log:", str(e))
+
     def insertFromMimeData(self, mimedata):
         # make sure pasted text goes through the device
         self.input.emit(mimedata.text())
@@ -244,6 +267,13 @@ class Console(QPlainTextEdit):
             self.appendWithCR(str, color)
             
     def appendBytes(self, b):
+        if self.log and b:
+            try:
+                self.log.write(b)
+            except OSError as e:
+                print("Console log write failed:", str(e))
+                self.set_log(None)
+        
         # prepend everything we might still have in buffer
         if len(self.buffer) > 0:
             b = self.buffer + b
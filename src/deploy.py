@@ -0,0 +1,216 @@
+#
+# deploy.py - write the same files to all connected boards in parallel
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+import asyncio, os, zipfile
+import serial.tools.list_ports
+
+from async_pyboard import AsyncPyboard
+from board import Board, local_files, code_mkdirs, parent_dirs
+from backup import MANIFEST
+
+def deploy_files(source):
+   # return the directories and the (name, data) of all files to be written
+   # from either a directory on the PC or a backup archive
+   if os.path.isdir(source):
+      files, dirs = local_files(source, "")
+      data = [ ]
+      for name in sorted(files):
+         with open(files[name], "rb") as f:
+            data.append( ( name, f.read() ) )
+      return dirs, data
+
+   with zipfile.ZipFile(source) as z:
+      names = [ n for n in z.namelist() if not n.endswith("/") and n != MANIFEST ]
+      data = [ ( "/" + n.lstrip("/"), z.read(n) ) for n in names ]
+
+   return parent_dirs([ name for name, _ in data ]), data
+
+# talk to all boards from one asyncio event loop in the background
+class DeployThread(QThread):
+   found = pyqtSignal(str)         # a board has been found at that port
+   progress = pyqtSignal(str, int)
+   status = pyqtSignal(str, str)
+   done = pyqtSignal(int, int)     # number of boards written and failed
+
+   PROBE_TIMEOUT = 3   # seconds a board has to respond
+
+   def __init__(self, source, ports):
+      super().__init__()
+      self.source = source
+      self.ports = ports
+
+   def run(self):
+      try:
+         dirs, files = deploy_files(self.source)
+      except Exception as e:
+         self.status.emit("", str(e))
+         self.done.emit(0, 0)
+         return
+
+      asyncio.run(self.deploy_all(dirs, files))
+
+   async def deploy_all(self, dirs, files):
+      results = await asyncio.gather(*(self.deploy(p, dirs, files) for p in self.ports))
+      self.done.emit(results.count(True), results.count(False))
+
+   async def deploy(self, port, dirs, files):
+      # returns None if there's no MicroPython board at that port. A port
+      # which can't even be opened in time isn't waited for
+      try:
+         pyb = await asyncio.wait_for(AsyncPyboard.open(port), self.PROBE_TIMEOUT)
+      except Exception:
+         return None
+
+      try:
+         try:
+            await asyncio.wait_for(pyb.enter_raw_repl(soft_reset=False), self.PROBE_TIMEOUT)
+         except Exception:
+            return None
+         self.found.emit(port)
+
+         if dirs: await pyb.exec_(code_mkdirs(dirs))
+
+         total = max(1, sum(len(data) for name, data in files))
+         written = 0
+         for name, data in files:
+            self.status.emit(port, self.tr("Writing {}").format(name.split("/")[-1]))
+            await pyb.fs_write_blocks(name, data,
+                  lambda sent: self.progress.emit(port, 100 * (written + sent) // total))
+            written += len(data)
+
+         await pyb.exit_raw_repl()
+         self.progress.emit(port, 100)
+         self.status.emit(port, self.tr("Done"))
+         return True
+      except Exception as e:
+         self.status.emit(port, self.tr("Failed: {}").format(str(e)))
+         return False
+      finally:
+         pyb.close()
+
+class DeployDialog(QDialog):
+   def __init__(self, parent=None):
+      super().__init__(parent)
+      self.setWindowTitle(self.tr("Deploy to all boards"))
+      self.resize(500, 300)
+      self.thread = None
+      self.source = None
+      self.rows = { }
+
+      vbox = QVBoxLayout()
+      vbox.addWidget(QLabel(self.tr("Write the same files to all MicroPython boards connected to this PC. "
+                                    "Existing files are overwritten.")))
+
+      hbox = QHBoxLayout()
+      self.source_label = QLabel(self.tr("No files selected"))
+      hbox.addWidget(self.source_label, 1)
+      self.dir_button = QPushButton(self.tr("Directory..."))
+      self.dir_button.clicked.connect(self.on_select_dir)
+      hbox.addWidget(self.dir_button)
+      self.zip_button = QPushButton(self.tr("Backup..."))
+      self.zip_button.clicked.connect(self.on_select_zip)
+      hbox.addWidget(self.zip_button)
+      vbox.addLayout(hbox)
+
+      self.table = QTableWidget(0, 3)
+      self.table.setHorizontalHeaderLabels([ self.tr("Port"), self.tr("Status"), self.tr("Progress") ])
+      self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+      self.table.verticalHeader().setVisible(False)
+      vbox.addWidget(self.table)
+
+      self.button_box = QDialogButtonBox(QDialogButtonBox.Close)
+      self.start_button = self.button_box.addButton(self.tr("Start"), QDialogButtonBox.AcceptRole)
+      self.start_button.setEnabled(False)
+      self.button_box.accepted.connect(self.on_start)
+      self.button_box.rejected.connect(self.reject)
+      vbox.addWidget(self.button_box)
+
+      self.setLayout(vbox)
+
+   def set_source(self, source):
+      if source:
+         self.source = source
+         self.source_label.setText(os.path.basename(source))
+         self.start_button.setEnabled(True)
+
+   def on_select_dir(self):
+      self.set_source(QFileDialog.getExistingDirectory(self, self.tr('Deploy directory'), '.'))
+
+   def on_select_zip(self):
+      self.set_source(QFileDialog.getOpenFileName(self, self.tr('Deploy backup'),'.',self.tr("Backup archive (*.zip)"))[0])
+
+   def enable_gui(self, enable):
+      self.start_button.setEnabled(enable)
+      self.dir_button.setEnabled(enable)
+      self.zip_button.setEnabled(enable)
+      self.button_box.button(QDialogButtonBox.Close).setEnabled(enable)
+
+   def on_start(self):
+      self.table.setRowCount(0)
+      self.rows = { }
+      self.enable_gui(False)
+
+      # Bluetooth ports are skipped like when scanning for a board
+      self.thread = DeployThread(self.source, [ p.device for p in serial.tools.list_ports.comports()
+                                                if Board.likely_port(p) ])
+      self.thread.found.connect(self.on_found)
+      self.thread.progress.connect(self.on_progress)
+      self.thread.status.connect(self.on_status)
+      self.thread.done.connect(self.on_done)
+      self.thread.start()
+
+   def on_found(self, port):
+      row = self.table.rowCount()
+      self.rows[port] = row
+      self.table.insertRow(row)
+      self.table.setItem(row, 0, QTableWidgetItem(port))
+      self.table.setItem(row, 1, QTableWidgetItem(self.tr("Connected")))
+      bar = QProgressBar()
+      bar.setMaximum(100)
+      self.table.setCellWidget(row, 2, bar)
+
+   def on_progress(self, port, val):
+      if port in self.rows:
+         self.table.cellWidget(self.rows[port], 2).setValue(val)
+
+   def on_status(self, port, msg):
+      if port in self.rows:
+         self.table.item(self.rows[port], 1).setText(msg)
+      else:
+         self.source_label.setText(msg)
+
+   def on_done(self, ok, failed):
+      self.thread.wait()
+      self.thread = None
+      self.enable_gui(True)
+      if not ok and not failed:
+         self.source_label.setText(self.tr("No board found"))
+      else:
+         self.source_label.setText(self.tr("{} boards written, {} failed").format(ok, failed))
+
+   def reject(self):
+      # the dialog cannot be closed while boards are being written
+      if not self.thread:
+         super().reject()
+
+   def deploy_dialog(parent=None):
+      dialog = DeployDialog(parent)
+      dialog.setWindowModality(Qt.ApplicationModal)
+      dialog.exec_()
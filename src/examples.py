@@ -29,6 +29,7 @@ class Examples(QObject):
     loaded = pyqtSignal(dict)
     imported = pyqtSignal(str, bytes, dict)
     file_imported = pyqtSignal(str, bytes, dict)
+    files_imported = pyqtSignal(dict)   # all additional files have been imported
     
     def __init__(self):
         super().__init__()        
@@ -148,6 +149,7 @@ class Examples(QObject):
         # no further files to import?
         if not "files" in ctx or not ctx["files"]:
             print("example import complete")
+            self.files_imported.emit(ctx)
             return
 
         # pull next file to be imported
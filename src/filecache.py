@@ -0,0 +1,93 @@
+#
+# filecache.py - host side copies of files read from the board
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from PyQt5.QtCore import *
+import os, hashlib
+
+class FileCache:
+   # Files are stored under the sha256 of their contents. The board
+   # calculates this hash for a file to be read, so for a file which is
+   # already known only the hash needs to be transferred. Identical files
+   # on different boards or paths share one entry.
+
+   MAX_SIZE = 64*1024*1024   # least recently used files are removed beyond this
+
+   def __init__(self, path = None):
+      if path is None:
+         path = os.path.join(QStandardPaths.writableLocation(
+            QStandardPaths.GenericCacheLocation), "upide", "files")
+      self.path = path
+
+   def filename(self, digest):
+      return os.path.join(self.path, digest)
+
+   def get(self, digest, size):
+      # return the cached data or None if it's not (or not correctly) cached
+      try:
+         with open(self.filename(digest), "rb") as f:
+            data = f.read()
+      except OSError:
+         return None
+
+      if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+         return None
+
+      # mark as recently used
+      try:
+         os.utime(self.filename(digest))
+      except OSError:
+         pass
+
+      return data
+
+   def put(self, digest, data):
+      # only store data which actually matches the hash the board reported.
+      # The file may have changed in between
+      if hashlib.sha256(data).hexdigest() != digest:
+         return False
+
+      try:
+         os.makedirs(self.path, exist_ok=True)
+         # write to a temporary file first, so there are never partial entries
+         tmp = self.filename(digest) + ".tmp"
+         with open(tmp, "wb") as f:
+            f.write(data)
+         os.replace(tmp, self.filename(digest))
+      except OSError as e:
+         print("Cache write failed:", str(e))
+         return False
+
+      self.trim()
+      return True
+
+   def trim(self):
+      try:
+         entries = [ e for e in os.scandir(self.path) if e.is_file() ]
+      except OSError:
+         return
+
+      # remove least recently used entries until the cache fits
+      entries.sort(key = lambda e: e.stat().st_mtime, reverse = True)
+      total = 0
+      for e in entries:
+         total += e.stat().st_size
+         if total > self.MAX_SIZE:
+            try:
+               os.remove(e.path)
+            except OSError:
+               pass
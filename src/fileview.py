@@ -21,22 +21,22 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
-from board import Board
 from examples import Examples
 
 class FileNode(object):
-   def __init__(self, name, size = None): 
+   # boards with large sd cards may have tens of thousands of entries
+   __slots__ = ( "name", "size", "_children", "_parent", "_row", "fetched", "fetching" )
+   
+   def __init__(self, name, size = None, fetched = True): 
       self.name = name
       self.size = size
-      self._children = []
+      # only directories get a list of their own
+      self._children = [] if size is None else ()
       self._parent = None
       self._row = 0
-      
-   def copy(self):
-      d = FileNode(self.name, self.size)
-      d._children = self._children
-      d._parent = self._parent
-      return d
+      # directories may be created before their contents have been listed
+      self.fetched = fetched
+      self.fetching = False
       
    def path(self):
       # check number of parents as we want to ignore the
@@ -58,17 +58,6 @@ class FileNode(object):
       elif column == FileView.COL_SIZE: return self.size;
       return None
 
-   def set(self, node):
-      # overwrite an entry with a different one (e.g. while renaming)
-      # the _row field is not changed and should already be correct as
-      # well as the _parent field
-      self.name = node.name
-      self.size = node.size
-      self._children = node._children
-      # adjust parent entries of all children
-      for c in self._children:
-         c._parent = self
-      
    def setData(self, column, data):      
       if column == FileView.COL_NAME:
          self.name = data
@@ -92,36 +81,61 @@ class FileNode(object):
       return self._parent
 
    def row(self):
+      # Rows aren't updated when siblings are inserted or removed. A
+      # stale row is detected and all siblings are renumbered at once
+      if self._parent is None:
+         return 0
+      siblings = self._parent._children
+      if self._row >= len(siblings) or siblings[self._row] is not self:
+         for i, c in enumerate(siblings):
+            c._row = i
       return self._row
 
    def addChild(self, child):
+      if not self._children: self._children = []
       child._parent = self
       child._row = len(self._children)
       self._children.append(child)
 
    def insertChild(self, row, child):
+      if not self._children: self._children = []
       child._parent = self
-      child._row = None
+      child._row = row
       self._children.insert(row, child)
-
-      # renumber all children from new one up
-      for i in range(row, len(self._children)):
-         self._children[i]._row = i
          
+   def bisect(self, name):
+      # children are sorted by name. Return the row a child of that
+      # name is to be inserted at
+      lo, hi = 0, len(self._children)
+      while lo < hi:
+         mid = (lo + hi) // 2
+         if self._children[mid].name < name:
+            lo = mid + 1
+         else:
+            hi = mid
+      return lo
+      
    def removeChild(self, row):
-      self._children.remove(self._children[row])
-      # renumber all children afterwards
-      for i in range(row, len(self._children)):
-         self._children[i]._row = i
+      self._children[row]._parent = None
+      del self._children[row]
       
    def __str__(self):
       return "FileNode {}({}) kids: {}".format(self.name, self.size, self.childCount());
       
 class FileModel(QAbstractItemModel):
+   fetch = pyqtSignal(str)   # contents of a directory are needed
+   icons = { }               # icons are shared by all models and only created once
+   
    def __init__(self, nodes):
       super().__init__()
       self._root = nodes
 
+      # all nodes below the invisible root by path. The "Board" node
+      # itself has the empty path
+      self.nodes = { }
+      for c in self._root._children:
+         self.addIndex(c)
+
       # Translate asset paths to useable format for PyInstaller
    def resource_path(self, relative_path):
       if hasattr(sys, '_MEIPASS'):
@@ -149,10 +163,177 @@ class FileModel(QAbstractItemModel):
    def removeRows(self, row, count, _parent=QModelIndex()):
       self.beginRemoveRows(_parent, row, row+count-1);
       for i in range(count):
-         self.getNode(_parent).removeChild(row+i)
+         node = self.getNode(_parent).child(row)
+         self.removeIndex(node, node.path())
+         self.getNode(_parent).removeChild(row)
       self.endRemoveRows()
       return True
 
+   def addIndex(self, node, path = None):
+      # add a node and everything below it to the path index
+      if path is None: path = node.path()
+      self.nodes[path] = node
+      for c in node._children:
+         self.addIndex(c, path + "/" + c.name)
+
+   def removeIndex(self, node, path):
+      self.nodes.pop(path, None)
+      for c in node._children:
+         self.removeIndex(c, path + "/" + c.name)
+
+   def findNode(self, path):
+      return self.nodes.get(path)
+
+   def insertNode(self, parent, node):
+      # insert a node including its children at its sorted position
+      row = parent.bisect(node.name)
+      self.beginInsertRows(self.nodeIndex(parent), row, row)
+      parent.insertChild(row, node)
+      self.endInsertRows()
+      self.addIndex(node)
+
+   def insertNodes(self, parent, row, nodes):
+      # insert a run of nodes in one go and return their number
+      if not nodes: return 0
+      self.beginInsertRows(self.nodeIndex(parent), row, row + len(nodes) - 1)
+      for i, node in enumerate(nodes):
+         node._parent = parent
+         node._row = row + i
+      parent._children[row:row] = nodes
+      self.endInsertRows()
+      for node in nodes:
+         self.addIndex(node)
+      return len(nodes)
+
+   def moveNode(self, node, parent, name):
+      # move and/or rename a node. The node itself is kept, so the view
+      # keeps its expansion state and the selection
+      old, row = node.parent(), node.row()
+      dest = parent.bisect(name)
+      self.removeIndex(node, node.path())
+      if old is not parent or not dest in ( row, row+1 ):
+         self.beginMoveRows(self.nodeIndex(old), row, row, self.nodeIndex(parent), dest)
+         del old._children[row]
+         if old is parent and dest > row: dest -= 1
+         node._parent = parent
+         node._row = dest
+         parent._children.insert(dest, node)
+         self.endMoveRows()
+      node.name = name
+      self.addIndex(node)
+      index = self.nodeIndex(node)
+      self.dataChanged.emit(index, index)
+
+   def update(self, parent, items):
+      # Make the children of parent match items, a list of new nodes
+      # sorted by name. Unchanged entries are kept, so the view keeps
+      # their expansion state and the selection. Consecutive rows are
+      # removed and inserted in one go
+      new = { n.name: n for n in items }
+      children = parent._children
+      path = parent.path()
+
+      def gone(n):
+         # new files which haven't been saved yet are only known locally
+         if not n.name in new: return n.size != -1
+         return new[n.name].isDir() != n.isDir()
+
+      end = len(children)
+      while end > 0:
+         if not gone(children[end-1]):
+            end -= 1
+            continue
+         start = end - 1
+         while start > 0 and gone(children[start-1]):
+            start -= 1
+         self.beginRemoveRows(self.nodeIndex(parent), start, end-1)
+         for n in children[start:end]:
+            self.removeIndex(n, path + "/" + n.name)
+            n._parent = None
+         del children[start:end]
+         self.endRemoveRows()
+         end = start
+
+      # both lists are sorted, so new entries are inserted while
+      # walking through them
+      row, run = 0, [ ]
+      for item in items:
+         while row < len(children) and children[row].name < item.name:
+            row += self.insertNodes(parent, row, run) + 1
+            run = [ ]
+         if row < len(children) and children[row].name == item.name:
+            row += self.insertNodes(parent, row, run)
+            run = [ ]
+            self.updateNode(children[row], item)
+            row += 1
+         else:
+            run.append(item)
+      self.insertNodes(parent, row, run)
+
+   def updateNode(self, node, item):
+      if node.isDir():
+         # directories of a flat listing come without their contents
+         if item.fetched:
+            self.update(node, item._children)
+            node.fetched = True
+      elif node.size != item.size:
+         node.size = item.size
+         index = self.nodeIndex(node)
+         self.dataChanged.emit(index, index.siblingAtColumn(FileView.COL_SIZE))
+
+   def removeNode(self, node):
+      parent = node.parent()
+      self.beginRemoveRows(self.nodeIndex(parent), node.row(), node.row())
+      self.removeIndex(node, node.path())
+      parent.removeChild(node.row())
+      self.endRemoveRows()
+
+   def nodeIndex(self, node):
+      if node is self._root:
+         return QModelIndex()
+      return QAbstractItemModel.createIndex(self, node.row(), 0, node)
+
+   def hasChildren(self, index=QModelIndex()):
+      node = self.getNode(index)
+      # directories which have not been listed yet may have children
+      if node.isDir() and not node.fetched:
+         return True
+      return node.childCount() > 0
+
+   def canFetchMore(self, index):
+      node = self.getNode(index)
+      return node.isDir() and not node.fetched and not node.fetching
+
+   def fetchMore(self, index):
+      # the listing is requested from the board. The entries are added
+      # through appendEntries() as they arrive
+      node = self.getNode(index)
+      node.fetching = True
+      self.fetch.emit(node.path())
+
+   def appendEntries(self, node, entries):
+      # entries are (name, size) tuples with size None for directories,
+      # whose contents are then listed on demand
+      path = node.path()
+      entries = sorted(( e for e in entries if path + "/" + e[0] not in self.nodes ),
+                       key = lambda e: e[0])
+      if not entries: return
+
+      if node.childCount() and node.child(node.childCount()-1).name > entries[0][0]:
+         # entries are inserted in between the existing ones one by one
+         for e in entries:
+            self.insertNode(node, FileNode(e[0], e[1], e[1] is not None))
+         return
+      
+      # entries all go behind the existing ones
+      first = node.childCount()
+      self.beginInsertRows(self.nodeIndex(node), first, first + len(entries) - 1)
+      for e in entries:
+         child = FileNode(e[0], e[1], e[1] is not None)
+         node.addChild(child)
+         self.nodes[path + "/" + e[0]] = child
+      self.endInsertRows()
+
    def rowCount(self, index):
       if index.isValid():
          return index.internalPointer().childCount()
@@ -196,7 +377,12 @@ class FileModel(QAbstractItemModel):
          return False
 
       if role == Qt.DisplayRole:
-         self.getNode(index).setData(index.column(), value)
+         node = self.getNode(index)
+         if index.column() == FileView.COL_NAME:
+            self.removeIndex(node, node.path())
+         node.setData(index.column(), value)
+         if index.column() == FileView.COL_NAME:
+            self.addIndex(node)
          self.dataChanged.emit(index, index)
          return True
 
@@ -208,25 +394,37 @@ class FileModel(QAbstractItemModel):
 
       node = self.getNode(index)
       
-      if role == Qt.ToolTipRole and  node.data(FileView.COL_SIZE) == -2:
+      if role == Qt.ToolTipRole and node.size == -2:
          return 'This filesystem is defective!'
          
       if index.column() == FileView.COL_NAME and role == Qt.DecorationRole:
          # no size? -> folder
-         if node.data(FileView.COL_SIZE) is None:
-            return QWidget().style().standardIcon(getattr(QStyle, "SP_DirIcon"))
-         elif node.data(FileView.COL_SIZE) == -2:
-            return QIcon(self.resource_path("assets/broken.svg"))
-         elif node.data(FileView.COL_NAME).endswith(".py"):
-            return QIcon(self.resource_path("assets/python.svg"))
+         if node.size is None:
+            return self.icon("dir")
+         elif node.size == -2:
+            return self.icon("broken")
+         elif node.name.endswith(".py"):
+            return self.icon("python")
          else:
-            return QWidget().style().standardIcon(getattr(QStyle, "SP_FileIcon"))
+            return self.icon("file")
     
       if role == Qt.DisplayRole:
          return node.data(index.column())
       
       return None
 
+   def icon(self, kind):
+      # data() is called for every visible row on each repaint. So the
+      # svg files are only parsed once
+      if not kind in self.icons:
+         if kind == "dir":
+            self.icons[kind] = QApplication.style().standardIcon(QStyle.SP_DirIcon)
+         elif kind == "file":
+            self.icons[kind] = QApplication.style().standardIcon(QStyle.SP_FileIcon)
+         else:
+            self.icons[kind] = QIcon(self.resource_path("assets/"+kind+".svg"))
+      return self.icons[kind]
+
    def supportedDropActions(self):
       return Qt.MoveAction
 
@@ -251,9 +449,10 @@ class ItalicDelegate(QStyledItemDelegate):
    # files that are not yet present on the device have size -1 and
    # are displayed in italics
    def paint(self, painter, option, index):
-      if index.siblingAtColumn(FileView.COL_SIZE).data(Qt.DisplayRole) == -1:
+      size = index.internalPointer().size
+      if size == -1:
          option.font.setItalic(True)
-      if index.siblingAtColumn(FileView.COL_SIZE).data(Qt.DisplayRole) == -2:
+      if size == -2:
          option.palette.setColor(QPalette.Text, QColor(255, 0, 0))
       QStyledItemDelegate.paint(self, painter, option, index)
 
@@ -267,15 +466,20 @@ class FileView(QTreeView):
    delete = pyqtSignal(str)   
    rename = pyqtSignal(str, str)   
    firmware = pyqtSignal()
+   deploy = pyqtSignal()
+   fetch = pyqtSignal(str)
    host_import = pyqtSignal(str, str)
    example_import = pyqtSignal(str, dict)
    example_imported = pyqtSignal(str, bytes, dict)
    example_file_imported = pyqtSignal(str, bytes, dict)
+   example_files_imported = pyqtSignal(dict)
    selection_changed = pyqtSignal(str)
    backup = pyqtSignal()
+   backup_incremental = pyqtSignal()
    restore = pyqtSignal()
    file_import = pyqtSignal(str)
    file_export = pyqtSignal(str, int)
+   sync = pyqtSignal(str)
    
    def __init__(self):
       super().__init__()
@@ -289,10 +493,16 @@ class FileView(QTreeView):
       self.firmwareAction = QAction(self.tr("Firmware..."), self.contextMenu);
       self.firmwareAction.triggered.connect(self.on_context_firmware)
       self.contextMenu.addAction(self.firmwareAction);      
+      self.deployAction = QAction(self.tr("Deploy to all boards..."), self.contextMenu);
+      self.deployAction.triggered.connect(self.on_context_deploy)
+      self.contextMenu.addAction(self.deployAction);
       self.backupMenu = self.contextMenu.addMenu(self.tr("Backup"))      
       self.backupAction = QAction(self.tr("Create..."), self.backupMenu);
       self.backupAction.triggered.connect(self.on_context_backup)
       self.backupMenu.addAction(self.backupAction);
+      self.incrementalAction = QAction(self.tr("Update..."), self.backupMenu);
+      self.incrementalAction.triggered.connect(self.on_context_backup_incremental)
+      self.backupMenu.addAction(self.incrementalAction);
       self.restoreAction = QAction(self.tr("Restore..."), self.backupMenu);
       self.restoreAction.triggered.connect(self.on_context_restore)
       self.backupMenu.addAction(self.restoreAction);
@@ -321,6 +531,9 @@ class FileView(QTreeView):
       self.exportAction = QAction(self.tr("Export to PC..."), self.newMenu);
       self.exportAction.triggered.connect(self.on_context_export)
       self.contextMenu.addAction(self.exportAction);
+      self.syncAction = QAction(self.tr("Sync from PC..."), self.contextMenu);
+      self.syncAction.triggered.connect(self.on_context_sync)
+      self.contextMenu.addAction(self.syncAction);
       
       self.setContextMenuPolicy(Qt.CustomContextMenu);
       self.customContextMenuRequested.connect(self.on_context_menu)
@@ -336,6 +549,7 @@ class FileView(QTreeView):
       self.examples.loaded.connect(self.on_examples_loaded)
       self.examples.imported.connect(self.on_example_imported)
       self.examples.file_imported.connect(self.on_example_file_imported)
+      self.examples.files_imported.connect(self.example_files_imported)
       self.examples.scan()
 
    def get_file_size(self, name):
@@ -413,50 +627,23 @@ class FileView(QTreeView):
    def sysname(self, name):
       self.rootname = name
       
-   def findNode(self, name, path = "", node = None):
-      if node is None:
-         node = self.model()._root.child(0)
-
-      for ci in range(node.childCount()):
-         child = node.child(ci)
-         if name.startswith(path+"/"+child.name+"/"):
-            return self.findNode(name, path+"/"+child.name, child)
-
-         if name == path+"/"+child.name:
-            return child   
-
-      return None
+   def findNode(self, name):
+      return self.model().findNode(name)
             
    def exists(self, name):
       # check if a file with this name already exists
       return self.findNode(name) is not None
 
-   def expand_(self, model, name, parent = QModelIndex()):
-      for r in range(model.rowCount(parent)):
-         index = model.index(r, 0, parent);
-         lname = model.data(index, 0);
-         # check if this is the directory we are searching for
-         if len(name) > 0 and lname == name[0] and model.hasChildren(index):
-            self.expand(index)
-            if len(name) > 1:
-               self.expand_(model, name[1:], index)
-
    def expandPath(self, name):
-      self.expand_(self.model(), (self.rootname + name).split("/"))
-
-   # get modelindex for a named entry
-   def getIndex(self, model, name, parent = QModelIndex()):
-      for r in range(model.rowCount(parent)):
-         index = model.index(r, FileView.COL_NAME, parent);
+      # expand all directories on the way to name
+      model = self.model()
+      node = self.findNode(name)
+      while node is not None and node is not model._root:
+         index = model.nodeIndex(node)
+         if model.hasChildren(index):
+            self.expand(index)
+         node = node.parent()
 
-         if model.data(index, Qt.DisplayRole) == name[0]:
-            if len(name) == 1:
-               return index
-         
-            # check if we should enter this directory
-            if len(name) > 1 and model.hasChildren(index):
-               return self.getIndex(model, name[1:], index)
-               
    def isValidFilename(self, name):
       not_allowed = "\\/:*\"<>|"
       if name == "": return False
@@ -489,7 +676,7 @@ class FileView(QTreeView):
    def add_file_entry(self, name, size = -1):
       # check if entry already exists
       if not self.exists(name):
-         self.addToModel(self.model(), (self.rootname + name).split("/"), [ name.split("/")[-1], size ])      
+         self.addNode(name, FileNode(name.split("/")[-1], size))
       
    def add_dir_entry(self, name):
       self.add_file_entry(name, None)
@@ -561,34 +748,33 @@ class FileView(QTreeView):
    def on_context_export(self):
       self.file_export.emit(self.context_entry[0], self.context_entry[1])
       
+   def on_context_sync(self):
+      self.sync.emit(self.context_entry[0])
+      
    def on_context_firmware(self):
       self.firmware.emit()
 
-   def get_next_file(self, name = None, node = None, path = ""):
-      if node == None:
-         node = self.model()._root.child(0)
-         self.return_next_name = (name == None)         
-         
-      for ci in range(node.childCount()):
-         child = node.child(ci)
-         
-         # return first match if no name was given
-         if child.size != None and self.return_next_name:
-            return path+"/"+child.name
-         
-         if name == path+"/"+child.name:
-            self.return_next_name = True
+   def on_context_deploy(self):
+      self.deploy.emit()
 
-         # decent into subdirs
-         if child.size == None:
-            r = self.get_next_file(name, child, path+"/"+child.name)
-            if r != None: return r 
+   def files(self, node = None, path = ""):
+      # iterate over all regular files in tree order as (path, size)
+      if node is None:
+         node = self.dirNode(path)
+         if node is None: return
 
-      return None
+      for child in node._children:
+         if child.isDir():
+            yield from self.files(child, path + "/" + child.name)
+         else:
+            yield path + "/" + child.name, child.size
       
    def on_context_backup(self):
       self.backup.emit()
       
+   def on_context_backup_incremental(self):
+      self.backup_incremental.emit()
+      
    def on_context_restore(self):
       self.restore.emit()
             
@@ -627,15 +813,9 @@ class FileView(QTreeView):
          self.message.emit(self.tr("A file with that name already exists"));
          return False
       
-      # get a copy of the old entry
-      entry = self.findNode(self.context_entry[0]).copy()
-
-      self.removeFromModel(self.model(), (self.rootname + self.context_entry[0]).split("/"))
-      self.addToModel(self.model(), (self.rootname + fullname).split("/"), [ name, 0 ])      
-
-      # update entry (so directories get their children back)
-      entry.name = name
-      self.findNode(fullname).set(entry)      
+      # move the entry including any children
+      entry = self.findNode(self.context_entry[0])
+      self.model().moveNode(entry, entry.parent(), name)
 
       # keep selection on renamed object
       self.select(fullname)
@@ -643,64 +823,20 @@ class FileView(QTreeView):
       # and finally request the actual rename
       self.rename.emit(self.context_entry[0], fullname)
 
-   def store(self, model, parent, index, obj):
-      # create a new (unset) row
-      model.insertRow(index, parent)
-      # and set data in that row
-      model.setData(model.index(index, FileView.COL_NAME, parent),\
-                    obj[0], Qt.DisplayRole)
-      model.setData(model.index(index, FileView.COL_SIZE, parent),\
-                    obj[1], Qt.DisplayRole)
-      
-      self.expand(parent)
-               
-   def addToModel(self, model, name, obj, parent = QModelIndex()):
-      if len(name) == 1:
-         # iterate over all children to find the one to insert before
-         for r in range(model.rowCount(parent)):
-            index = model.index(r, FileView.COL_NAME, parent);
-            name = model.data(model.index(r, FileView.COL_NAME, parent), Qt.DisplayRole);
-
-            if name > obj[0]:
-               self.store(model, parent, r, obj)
-               return
-
-         # no item to insert before, so append
-         self.store(model, parent, model.rowCount(parent), obj)
+   def addNode(self, fullname, node):
+      # insert a node into its directory at its sorted position
+      parent = self.dirNode("/".join(fullname.split("/")[:-1]))
+      if parent is None or not parent.isDir():
          return
-      else:         
-         # iterate over all children
-         for r in range(model.rowCount(parent)):
-            index = model.index(r, FileView.COL_NAME, parent);
-            size = model.data(model.index(r, FileView.COL_SIZE, parent), Qt.DisplayRole);
-
-            # check if we should enter this directory (size == None -> isdir)
-            # We cannot check with hasChildren here as we also want to
-            # handle empty directories
-            if model.data(index, Qt.DisplayRole) == name[0] and len(name) > 1 and size == None:
-               self.addToModel(model, name[1:], obj, index)        
-               
-   # remove item from model
-   def removeFromModel(self, model, name, parent = QModelIndex()):
-      for r in range(model.rowCount(parent)):
-         index = model.index(r, FileView.COL_NAME, parent);
-
-         if model.data(index, Qt.DisplayRole) == name[0]:
-            if len(name) == 1:
-               model.removeRow(r, parent)
-               return
-         
-            # check if we should enter this directory
-            if len(name) > 1 and model.hasChildren(index):
-               self.removeFromModel(model, name[1:], index)        
+      
+      self.model().insertNode(parent, node)
+      self.expand(self.model().nodeIndex(parent))
 
    def remove(self, fullname):
-      # get only the path
-      path = "/".join(fullname.split("/")[:-1])
-      name = fullname.split("/")[-1]
-            
       # Instead of updating the entire tree view just remove the row
-      self.removeFromModel(self.model(), (self.rootname + fullname).split("/"))
+      node = self.findNode(fullname)
+      if node is not None:
+         self.model().removeNode(node)
                
    def on_context_delete(self):
       qm = QMessageBox()
@@ -732,9 +868,14 @@ class FileView(QTreeView):
          self.context_entry = (name, size)
 
          self.setCurrentIndex(index)
+
+         # the checks for existing files need the directory's contents
+         if index.model().canFetchMore(index):
+            index.model().fetchMore(index)
       
          # only the root entry has the firmware entry ...
          self.firmwareAction.setVisible(size == None and name == "")
+         self.deployAction.setVisible(size == None and name == "")
          # ... and also the backup
          self.backupMenu.menuAction().setVisible(size == None and name == "")
          
@@ -748,6 +889,9 @@ class FileView(QTreeView):
          
          # new files can be created for directories
          self.newMenu.menuAction().setVisible(size == None)
+
+         # and directories can be synced with one on the PC
+         self.syncAction.setVisible(size == None)
          if self.examplesMenu: self.examplesMenu.menuAction().setVisible(size == None)
 
          # the open entry is visible for all regular files but only some can be edited
@@ -778,38 +922,17 @@ class FileView(QTreeView):
                if self.is_editable(name):
                   self.open.emit(name, size)
                   
-   def updateModel(self, model, name, new_name, new_size, parent = QModelIndex()):
-      # and update entry in model
-      for r in range(model.rowCount(parent)):
-         index = model.index(r, FileView.COL_NAME, parent);
-         lname = model.data(index, Qt.DisplayRole);
-
-         if lname == name[0]:
-            if len(name) == 1:
-               # update size if requested ...
-               if new_size is not None:
-                  size_index = index.siblingAtColumn(FileView.COL_SIZE)
-                  model.setData(size_index, new_size, Qt.DisplayRole)
-               # ... or name
-               if new_name is not None:
-                  name_index = index.siblingAtColumn(FileView.COL_NAME)
-                  model.setData(name_index, new_name, Qt.DisplayRole)
-         
-            # check if we should enter this directory
-            if len(name) > 1 and model.hasChildren(index):
-               self.updateModel(model, name[1:], new_name, new_size, index)        
-                  
    def saved(self, name, size):
       # update size of entry in file list
       entry = self.findNode(name)
       if entry != None:
          entry.size = size
-
-      self.updateModel(self.model(), (self.rootname + name).split("/"), None, size)      
+         index = self.model().nodeIndex(entry)
+         self.model().dataChanged.emit(index, index.siblingAtColumn(FileView.COL_SIZE))
                   
    def getItems(self, files, path):
       items = [ ]
-      for f in files:
+      for f in sorted(files, key = lambda f: f[0]):
          filename = path + "/" + f[0]
          if isinstance(f[1], int):
             node = FileNode(f[0], f[1])
@@ -820,17 +943,34 @@ class FileView(QTreeView):
          items.append(node)
       return items
       
-   def set(self, files):
+   def set(self, files, listed = True):
+      rootdir = self.dirNode("") if self.model() else None
+      if files != None and rootdir is not None:
+         # The existing tree is updated. So the expanded directories
+         # and the selection are kept
+         if rootdir.name != self.rootname:
+            self.model().setData(self.model().nodeIndex(rootdir), self.rootname, Qt.DisplayRole)
+         if listed:
+            self.model().update(rootdir, self.getItems(files, ""))
+            rootdir.fetched = True
+         # otherwise the caller requests a new listing
+         rootdir.fetching = not listed
+         return
+      
       # invisible root item
       root = FileNode("")
 
       if files != None:
-         rootdir = FileNode(self.rootname)
+         # If the root directory isn't listed yet, the caller requests
+         # the listing. Subdirectories are then fetched on demand
+         rootdir = FileNode(self.rootname, fetched = listed)
+         rootdir.fetching = not listed
          root.addChild(rootdir)
          for i in self.getItems(files, ""):
             rootdir.addChild(i)
       
       model = FileModel(root)
+      model.fetch.connect(self.fetch)
       self.setModel(model)
       self.setItemDelegate(ItalicDelegate(self))
 
@@ -839,6 +979,45 @@ class FileView(QTreeView):
 
       self.selectionModel().selectionChanged.connect(self.onSelectionChanged)
 
+   def dirNode(self, path):
+      return self.findNode(path)
+         
+   def add_entries(self, path, entries):
+      # entries of a directory listing have arrived
+      node = self.dirNode(path)
+      if node and node.isDir() and not node.fetched:
+         self.model().appendEntries(node, entries)
+
+   def fetched(self, path, success = True, entries = None):
+      # the listing of a directory is complete. If it failed, the
+      # directory is listed again once it's being expanded again
+      node = self.dirNode(path)
+      if node and node.isDir():
+         if success and entries is not None and node.fetched:
+            # a directory listed before has been listed again
+            self.model().update(node, [ FileNode(e[0], e[1], e[1] is not None)
+                                        for e in sorted(entries, key = lambda e: e[0]) ])
+         if success: node.fetched = True
+         node.fetching = False
+
+   def listed_dirs(self):
+      # all directories whose contents are known, parents first
+      return sorted(p for p, n in self.model().nodes.items() if n.isDir() and n.fetched)
+
+   def unlisted_dir(self, name):
+      # return the path of the first directory on the way to name
+      # whose contents haven't been listed yet
+      path = ""
+      node = self.dirNode(path)
+      for part in name.split("/")[1:]:
+         if node is None or not node.isDir():
+            return None
+         if not node.fetched:
+            return path
+         path += "/" + part
+         node = self.findNode(path)
+      return None
+      
    def onSelectionChanged(self, sel, desel):
       if len(sel.indexes()) > 0:
          index = sel.indexes()[0]
@@ -972,26 +1151,25 @@ class FileView(QTreeView):
                self.message.emit(self.tr("A file or directory with that name already exists"));
                return
 
-            # get a copy of the old entry
-            entry = self.findNode(self.dragNode.path()).copy()         
-            self.removeFromModel(self.model(), (self.rootname + self.dragNode.path()).split("/"))
-            self.addToModel(self.model(), (self.rootname + fullname).split("/"), [ self.dragNode.name, 0 ])      
-
-            # update entry (so directories get their children back)
-            self.findNode(fullname).set(entry)      
+            # move the entry including any children
+            oldname = self.dragNode.path()
+            self.model().moveNode(self.dragNode, self.eventNode(event), self.dragNode.name)
+            self.expand(self.indexAt(event.pos()))
 
             # keep selection on renamed object
             self.select(fullname)
 
             # and finally request the actual rename
-            self.rename.emit(self.dragNode.path(), fullname)
+            self.rename.emit(oldname, fullname)
 
    def select(self, fullname):
-      self.setCurrentIndex(self.getIndex(self.model(), (self.rootname + fullname).split("/")))
+      node = self.findNode(fullname)
+      if node is not None:
+         self.setCurrentIndex(self.model().nodeIndex(node))
             
    def add(self, fullname, length):
       name = fullname.split("/")[-1]
       # add new file to tree
-      self.addToModel(self.model(), (self.rootname + fullname).split("/"), [ name, length ])
+      self.addNode(fullname, FileNode(name, length))
       # and select it
       self.select(fullname)
@@ -70,7 +70,7 @@ Or:
 import sys
 import time
 import os
-import ast
+import binascii
 
 try:
     stdout = sys.stdout.buffer
@@ -89,6 +89,81 @@ class PyboardError(Exception):
     pass
 
 
+def fs_decode_block(line):
+    # decode one base64 block as sent by fs_read_blocks and verify its checksum
+    try:
+        block = binascii.a2b_base64(line)
+    except (binascii.Error, ValueError) as e:
+        raise PyboardError("fs_get: Could not interpret received data: %s" % str(e))
+    if len(block) < 2 or sum(block[2:]) & 0xFFFF != block[0] << 8 | block[1]:
+        raise PyboardError("fs_get: Checksum mismatch in received data")
+    return block[2:]
+
+
+def fs_read_blocks_cmd(src, chunk_size):
+    # Device code which sends a file as lines of base64. Each block carries
+    # a 16 bit checksum of its payload in its first two bytes.
+    return (
+        "import sys,ubinascii\nw=getattr(sys.stdout,'buffer',sys.stdout).write\n"
+        "b=bytearray(%u)\nm=memoryview(b)\nwith open('%s','rb') as f:\n while 1:\n"
+        "  n=f.readinto(m[2:])\n  if not n:break\n  s=sum(m[2:2+n])\n"
+        "  b[0]=s>>8&255\n  b[1]=s&255\n  w(ubinascii.b2a_base64(m[:2+n]))"
+        % (chunk_size + 2, src)
+    )
+
+
+def fs_block_line_consumer(block_consumer):
+    # Return a data consumer which splits the output of fs_read_blocks_cmd
+    # into lines and passes the decoded blocks on to block_consumer
+    pending = bytearray()
+
+    def line_consumer(data):
+        pending.extend(data)
+        while True:
+            i = pending.find(b"\n")
+            if i < 0:
+                break
+            line = bytes(pending[:i]).strip(b"\r\x04")
+            del pending[: i + 1]
+            if line:
+                block_consumer(fs_decode_block(line))
+
+    return line_consumer
+
+
+def fs_write_blocks_cmd(dest, mode="wb", pre="", head="", tail="", post=""):
+    # Device code of the receiver used by fs_write_blocks. It acknowledges
+    # its start and every block written with \x01. An empty line ends it.
+    # The file is opened as f with the given mode. Other ways of writing
+    # can be built with the optional code run before the file is opened
+    # (pre), once it's open (head), after the last block (tail) and after
+    # it's closed (post). head and tail are indented by one space.
+    return (
+        "import sys,ubinascii\nr=sys.stdin.readline\nw=sys.stdout.write\n%s"
+        "with open('%s','%s') as f:\n%s w('\\x01')\n while 1:\n"
+        "  d=ubinascii.a2b_base64(r())\n  if not d:break\n  m=memoryview(d)[2:]\n"
+        "  if sum(m)&65535!=d[0]<<8|d[1]:raise ValueError('checksum mismatch')\n"
+        "  f.write(m)\n  w('\\x01')\n%s%s" % (pre, dest, mode, head, tail, post)
+    )
+
+
+# bytes fs_write_blocks keeps in flight if the device doesn't use
+# raw-paste mode and thus reports no window. The raw REPL itself is
+# sent 256 bytes at a time, too
+FS_WRITE_WINDOW = 256
+
+
+def fs_write_chunk_size(window):
+    # largest payload whose base64 line still fits into the raw-paste window
+    return (window - 1) // 4 * 3 - 2
+
+
+def fs_encode_block(data):
+    # encode one block for fs_write_blocks, prefixed by its checksum
+    s = sum(data) & 0xFFFF
+    return binascii.b2a_base64(bytes((s >> 8, s & 0xFF)) + data)
+
+
 class TelnetToSerial:
     def __init__(self, ip, user, password, read_timeout=None):
         self.tn = None
@@ -257,6 +332,7 @@ class Pyboard:
     ):
         self.in_raw_repl = False
         self.use_raw_paste = True
+        self.raw_paste_window = 128  # updated once the device reported its window
         if device.startswith("exec:"):
             self.serial = ProcessToSerial(device[len("exec:") :])
         elif device.startswith("execpty:"):
@@ -302,29 +378,45 @@ class Pyboard:
         # if data_consumer is used then data is not accumulated and the ending must be 1 byte long
         assert data_consumer is None or len(ending) == 1
 
-        data = self.serial.read(min_num_bytes)
-        if data_consumer:
-            data_consumer(data)
-        timeout_count = 0
+        # Transports which can stop reading at the ending are read in bulk
+        bulk = hasattr(self.serial, "read_until")
+
+        data = bytearray()
+        new_data = self.serial.read(min_num_bytes)
+        last_data = time.monotonic()
         while True:
-            if data.endswith(ending):
-                break
-            elif self.serial.inWaiting() > 0:
-                new_data = self.serial.read(1)
+            if new_data:
                 if data_consumer:
-                    data_consumer(new_data)
-                    data = new_data
-                else:
-                    data = data + new_data
-                timeout_count = 0
-            else:
-                timeout_count += 1
-                if timeout is not None and timeout_count >= 100 * timeout:
+                    data = bytearray()
+                start = max(0, len(data) - len(ending) + 1)
+                data += new_data
+                i = data.find(ending, start)
+                if data_consumer:
+                    data_consumer(bytes(data))
+                if i >= 0:
                     break
-                if self._interrupt:
-                    raise RuntimeError("Stop failed")
+                last_data = time.monotonic()
+            elif timeout is not None and time.monotonic() - last_data >= timeout:
+                break
+            elif self._interrupt:
+                raise RuntimeError("Stop failed")
+            elif hasattr(self.serial, "wait"):
+                # sleep until data arrives, but check for interrupts now and then
+                self.serial.wait(0.05)
+            else:
                 time.sleep(0.01)
-        return data
+
+            if self.serial.inWaiting() <= 0:
+                new_data = b""
+            elif bulk:
+                # only ask for the part of the ending not yet received
+                k = min(len(ending) - 1, len(data))
+                while k and not data.endswith(ending[:k]):
+                    k -= 1
+                new_data = self.serial.read_until(ending[k:])
+            else:
+                new_data = self.serial.read(1)
+        return bytes(data)
 
     def enter_raw_repl(self, soft_reset=True):
         self.serial.write(b"\r\x03\x03")  # ctrl-C twice: interrupt any running program
@@ -384,6 +476,7 @@ class Pyboard:
         data = self.serial.read(2)
         window_size = data[0] | data[1] << 8
         window_remain = window_size
+        self.raw_paste_window = window_size
 
         # Write out the command_bytes data.
         i = 0
@@ -495,36 +588,72 @@ class Pyboard:
         )
         self.exec_(cmd, data_consumer=stdout_write_bytes)
 
-    def fs_get(self, src, dest, chunk_size=256):
-        self.exec_("f=open('%s','rb')\nr=f.read" % src)
+    def fs_read_blocks(self, src, block_consumer, chunk_size=512):
+        # Stream the whole file in a single exec, decoding and verifying
+        # the blocks incrementally as they arrive
+        self.exec_(fs_read_blocks_cmd(src, chunk_size),
+                   data_consumer=fs_block_line_consumer(block_consumer))
+
+    def fs_get(self, src, dest, chunk_size=512):
         with open(dest, "wb") as f:
-            while True:
-                data = bytearray()
-                self.exec_("print(r(%u))" % chunk_size, data_consumer=lambda d: data.extend(d))
-                assert data.endswith(b"\r\n\x04")
-                try:
-                    data = ast.literal_eval(str(data[:-3], "ascii"))
-                    if not isinstance(data, bytes):
-                        raise ValueError("Not bytes")
-                except (UnicodeError, ValueError) as e:
-                    raise PyboardError("fs_get: Could not interpret received data: %s" % str(e))
-                if not data:
-                    break
-                f.write(data)
-        self.exec_("f.close()")
+            self.fs_read_blocks(src, f.write, chunk_size)
+
+    def fs_wait_ack(self):
+        # wait for the receiver of fs_write_blocks to acknowledge a block
+        data = self.serial.read(1)
+        if data == b"\x01":
+            return
+        if data == b"\x04":
+            # Receiver has stopped, probably due to an exception. Fetch its
+            # error output and report it like exec_() does.
+            data_err = self.read_until(1, b"\x04")
+            # Lines sent meanwhile end up in the next raw REPL command.
+            # Resetting the raw REPL discards them. Its prompt is left
+            # for the next command
+            self.serial.write(b"\x01")
+            self.read_until(1, b"raw REPL; CTRL-B to exit\r\n", timeout=1)
+            raise PyboardError("exception", b"", data_err[:-1])
+        if not data:
+            raise PyboardError("fs_put: timeout waiting for acknowledge")
+        raise PyboardError("fs_put: unexpected read during transfer: {}".format(data))
+
+    def fs_write_blocks(self, dest, data, progress=None, window=2, cmd=None):
+        # Install a small receiver loop on the device and stream the data to
+        # it as base64 lines with a leading 16 bit checksum. The receiver
+        # acknowledges every block once written. Up to "window" blocks may be
+        # in flight. Together they fit into the raw-paste window the device
+        # reported, so its input buffer cannot overflow. A receiver built by
+        # fs_write_blocks_cmd() may be given as cmd.
+        self.exec_raw_no_follow(cmd or fs_write_blocks_cmd(dest))
+        self.fs_wait_ack()
+        chunk_size = fs_write_chunk_size(
+            (self.raw_paste_window if self.use_raw_paste else FS_WRITE_WINDOW) // window)
+
+        # slice through a memoryview so blocks are not copied
+        data = memoryview(data)
+        in_flight = 0
+        for i in range(0, len(data), chunk_size):
+            while in_flight >= window or (in_flight and self.serial.inWaiting()):
+                self.fs_wait_ack()
+                in_flight -= 1
+            self.serial.write(fs_encode_block(data[i : i + chunk_size]))
+            in_flight += 1
+            if progress:
+                progress(min(i + chunk_size, len(data)))
+
+        while in_flight:
+            self.fs_wait_ack()
+            in_flight -= 1
+
+        # an empty line ends the transfer
+        self.serial.write(b"\n")
+        ret, ret_err = self.follow(10)
+        if ret_err:
+            raise PyboardError("exception", ret, ret_err)
 
-    def fs_put(self, src, dest, chunk_size=256):
-        self.exec_("f=open('%s','wb')\nw=f.write" % dest)
+    def fs_put(self, src, dest):
         with open(src, "rb") as f:
-            while True:
-                data = f.read(chunk_size)
-                if not data:
-                    break
-                if sys.version_info < (3,):
-                    self.exec_("w(b" + repr(data) + ")")
-                else:
-                    self.exec_("w(" + repr(data) + ")")
-        self.exec_("f.close()")
+            self.fs_write_blocks(dest, f.read())
 
     def fs_mkdir(self, dir):
         self.exec_("import uos\nuos.mkdir('%s')" % dir)
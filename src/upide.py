@@ -22,11 +22,13 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
-from board import Board
+from board import Board, parent_dirs
 from fileview import FileView
 from console import Console
 from editors import Editors
 from esp_installer import EspInstaller
+from deploy import DeployDialog
+from backup import read_manifest
 import zipfile
 
 class Window(QMainWindow):
@@ -64,7 +66,8 @@ class Window(QMainWindow):
       # save info about open editors
       self.settings.setValue('editor_open', self.editors.getAll())
       self.settings.setValue('editor_current', self.editors.get_current())
-      
+
+      self.console.set_log(None)
       event.accept()
 
    def resource_path(relative_path):
@@ -130,7 +133,9 @@ class Window(QMainWindow):
       # User has requested to save the code he edited
       self.on_board_request(True)
       self.console.set_button(None)
-      self.board.cmd(Board.PUT_FILE, self.on_save_done, { "name": name, "code": code } )
+      # existing files are written as a delta if possible
+      self.board.cmd(Board.PUT_FILE, self.on_save_done, { "name": name, "code": code,
+                                                          "delta": not new_file } )
       
    def on_code_downloaded(self):
       # code to be run has been downloaded to the board:
@@ -206,7 +211,7 @@ class Window(QMainWindow):
             # if size is >= 0 this is an existing file, so load it
             self.on_board_request(True)
             self.console.set_button(None)
-            self.board.cmd(Board.GET_FILE, self.on_file, { "name": name, "size": size } )
+            self.board.cmd(Board.GET_FILE, self.on_file, { "name": name, "size": size, "cache": True } )
          else:
             # else it's a newly created file
             self.editors.new(name)
@@ -222,66 +227,86 @@ class Window(QMainWindow):
          self.zip.close()
          self.zip = None
 
-   def on_backup_file(self, success, ctx):
-      if not success:
-         # backup failed
-         self.backup_done(False, "Board com failed")
-         return
+      if self.previous_zip:
+         self.previous_zip.close()
+         self.previous_zip = None
+
+   def on_backup_written(self, success, result=None):
+      incremental = self.previous_zip is not None
+      self.backup_done(success, "" if success else "Board com failed")
+      if success and incremental:
+         self.status(self.tr("Backup successful: {} files read, {} unchanged").format(
+            result["read"], result["unchanged"]))
+      
+   def on_backup_incremental(self):
+      # user wants to make a backup based on a previous one. Only the
+      # files which have changed since are read from the board
+      fname = QFileDialog.getOpenFileName(self, self.tr('Previous backup'),'.',self.tr("Backup archive (*.zip)"))[0]
+      if not fname: return
 
       try:
-         # write file to zip, but without leading slash
-         name = ctx["name"]
-         if name.startswith("/"):
-            name = name[1:]
-         
-         with self.zip.open(name, mode='w') as f:
-            f.write(ctx["code"])
-            f.close()
+         previous = zipfile.ZipFile(fname, 'r')
       except Exception as e:
-         self.backup_done(False, str(e))
+         self.on_message(self.tr("Reading the previous backup failed:") + "\n\n" + str(e))
          return
-            
-      # backup next file
-      self.backup_file(self.fileview.get_next_file(ctx["name"]))
 
-   def backup_file(self, f):
-      if not f:
-         # no more file to backup
-         self.backup_done(True)
+      if read_manifest(previous) is None:
+         previous.close()
+         self.on_message(self.tr("The previous backup doesn't contain a manifest. Please create a full backup first."))
          return
 
-      # get file node
-      node = self.fileview.findNode(f)
-      if not node:
-         # problem getting file node
-         print("ERROR getting node for", f)
-         self.backup_done(False, "No node")
-         return
-         
-      self.status(self.tr("Backing up: ")+f.split("/")[-1])
-      self.board.cmd(Board.GET_FILE, self.on_backup_file, { "name": f, "size": node.size } )
+      self.on_backup(previous)
       
       # user wants to make a full backup
-   def on_backup(self):            
+   def on_backup(self, previous = None):
+      self.previous_zip = previous
+      
       # select a zip file to backup into
       fname = QFileDialog.getSaveFileName(self, self.tr('Create backup'),'.',self.tr("Backup archive (*.zip)"))[0]
+      if not fname and previous:
+         previous.close()
+         self.previous_zip = None
       if fname:
          if not fname.lower().endswith(".zip"):
             fname = fname + ".zip"
 
+         # the previous backup is still needed while the new one is written
+         if previous and os.path.abspath(fname) == os.path.abspath(previous.filename):
+            previous.close()
+            self.previous_zip = None
+            self.on_message(self.tr("The new backup must not replace the previous one."))
+            return
+
          # disable gui during backup
          self.on_board_request(True)
          self.console.set_button(None)
       
+         # The compression level may be set in the settings. Level 0
+         # just stores the files
+         level = self.settings.value('backup_compression', 6, type=int)
          try:
-            self.zip = zipfile.ZipFile(fname, 'w')
+            self.zip = zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED,
+                                       compresslevel = level if level else None)
          except Exception as e:
             self.backup_done(False, str(e))
             return
 
-         # start backup with first file
-         f = self.fileview.get_next_file()
-         self.backup_file(f)
+         # the backup needs the complete file tree
+         self.board.cmd(Board.LISTDIR, self.on_backup_listdir)
+
+   def on_backup_listdir(self, success, files=None):
+      if not success:
+         self.backup_done(False, "Board com failed")
+         return
+
+      self.fileview.set(files)
+      
+      # all files are downloaded straight into the archive in one go.
+      # New files not saved yet are only known locally
+      files = [ f for f in self.fileview.files() if f[1] >= 0 ]
+      self.board.cmd(Board.BACKUP, self.on_backup_written, { "files": files, "archive": self.zip,
+                     "threaded": self.settings.value('backup_thread', True, type=bool),
+                     "previous": self.previous_zip })
          
    def restore_done(self, ok):
       if ok: self.status(self.tr("Restoration successful"))
@@ -295,87 +320,11 @@ class Window(QMainWindow):
       # re-enable the ui
       self.board.cmd(Board.LISTDIR, self.on_listdir)
       
-   def restore_get_next_file(self, f = None):
-      files = self.zip.namelist()
-      if not f:
-         # no filename give -> restore first file
-         idx = -1
-      else:
-         idx = files.index(f)
-         if idx < 0: return None
-
-      while idx+1 < len(files):
-         # don't explicitely restore directories. They
-         # are implicitely restored via the file names. This
-         # should actually never happen with the backup
-         # files as they don't explicitely store directories at all
-         fname = files[idx+1]
-         if not fname.endswith("/"):
-            return fname
-
-         idx = idx + 1
-         
-      return None
-         
-   def mkdir(self, name):
-      try:
-         self.board.mkdir(name)
-      except Exception as e:
-         return False
-
-      return True
-
-   def on_restore_file(self, success, parms):
-      if not success:
-         self.restore_done(False)
-         return
-      
-      # restore next file
-      f = self.restore_get_next_file(self.restore_file_name)
-      if f == None:
-         self.restore_done(True)
-         return
-
-      self.restore_file(f)
-
-   def mkpath(self, path):
-      # treat all paths as absolute
-      if path.startswith("/"):
-         path = path[1:]
-      
-      # check if whole path exists
-      path_parts = path.split("/")[:-1]
-      if len(path_parts) > 0:
-         # check if path already exists
-         for i in range(len(path_parts)):
-            check_path = "/" + "/".join(path_parts[:i+1])
-            if not self.fileview.exists(check_path):
-               if self.mkdir(check_path):
-                  self.fileview.add_dir_entry(check_path)
-               else:
-                  return False
-               
-      return True      
-      
-   def restore_file(self, f):
-      self.status(self.tr("Restoring: ")+f.split("/")[-1])
-
-      if not self.mkpath(f):
-         # failed to create directory. Abort restore
-         self.restore_done(False)
-         return
-      
-      # full path should now exist, so restore file      
-      try:
-         with self.zip.open(f, 'r') as infile:
-            data = infile.read()
-            infile.close()
-            self.restore_file_name = f
-            self.board.cmd(Board.PUT_FILE, self.on_restore_file, { "name": f, "code": data } )
-      except Exception as e:
-         print("restore exception", str(e))
-         self.restore_done(False)
-         return
+   def on_restore_written(self, success, result=None):
+      self.restore_done(success)
+      if success and result["unchanged"]:
+         self.status(self.tr("Restoration successful: {} written, {} unchanged").format(
+            result["written"], result["unchanged"]))
 
       # user wants to import a file from PC
    def on_file_import(self, dir_name):
@@ -420,6 +369,43 @@ class Window(QMainWindow):
          self.console.set_button(None)
          self.board.cmd(Board.GET_FILE, self.on_export_file, { "name": name, "size": size, "fname": fname } )
 
+   def on_sync_done(self, success, result=None):
+      if success:
+         self.status(self.tr("Sync done: {} written, {} unchanged, {} deleted").format(
+            result["written"], result["unchanged"], result["deleted"]))
+
+         # open editors of overwritten files show the new contents
+         for name, path in result["files"].items():
+            if self.editors.exists(name):
+               try:
+                  with open(path, "rb") as f:
+                     self.editors.saved(name, f.read())
+               except OSError:
+                  pass
+      else:
+         self.status(self.tr("Sync failed"))
+
+      # only the file tree is refreshed, the editors are kept as they are
+      self.reload_files(False)
+      
+      # user wants to make a board directory match a directory on the PC
+   def on_sync(self, remote):
+      local = QFileDialog.getExistingDirectory(self, self.tr('Sync from directory'), '.')
+      if not local: return
+
+      qm = QMessageBox()
+      ret = qm.question(self, self.tr('Delete files?'),
+                        self.tr("Delete files on the board which don't exist on the PC?"),
+                        qm.Yes | qm.No | qm.Cancel, qm.No)
+      if ret == qm.Cancel: return
+
+      # disable gui during sync
+      self.on_board_request(True)
+      self.console.set_button(None)
+      self.status(self.tr("Syncing ..."))
+      self.board.cmd(Board.SYNC, self.on_sync_done,
+                     { "local": local, "remote": remote, "delete": ret == qm.Yes })
+
       # user wants to restore a full backup
    def on_restore(self):            
       # select a zip file to extract backup from
@@ -428,6 +414,12 @@ class Window(QMainWindow):
          if not fname.lower().endswith(".zip"):
             fname = fname + ".zip"
 
+         qm = QMessageBox()
+         ret = qm.question(self, self.tr('Skip identical files?'),
+                           self.tr("Skip files which are identical on the board already?"),
+                           qm.Yes | qm.No | qm.Cancel, qm.No)
+         if ret == qm.Cancel: return
+
          # disable gui during restore
          self.on_board_request(True)
          self.console.set_button(None)
@@ -438,34 +430,38 @@ class Window(QMainWindow):
             self.restore_done(False)
             return
 
-         f = self.restore_get_next_file()
-         if not f:
-            self.restore_done(True)
-            return
-            
-         self.restore_file(f)
+         # the sizes of all files are needed to find those which may be
+         # identical. Otherwise everything is written right away
+         if ret == qm.Yes:
+            self.board.cmd(Board.LISTDIR, self.on_restore_listdir)
+         else:
+            self.status(self.tr("Restoring ..."))
+            self.board.cmd(Board.RESTORE, self.on_restore_written, { "archive": self.zip })
+
+   def on_restore_listdir(self, success, files=None):
+      if not success:
+         self.restore_done(False)
+         return
+      
+      # restore everything in one go
+      self.fileview.set(files)
+      self.status(self.tr("Restoring ..."))
+      self.board.cmd(Board.RESTORE, self.on_restore_written,
+                     { "archive": self.zip, "existing": dict(self.fileview.files()) })
             
-   def show_exception(self, e):
-      # this was an exception forwarded from the target 
-      if len(e.args) == 3 and e.args[0] == "exception":
-         self.on_error(None, e.args[2].decode("ascii"))
-      else:
-         self.on_error(None, str(e))
-         
+   def on_file_op_done(self, success, result=None):
+      # the file view shows the change already. If the board failed to
+      # make it, the error has been reported and the files are listed again
+      if not success: self.reload_files(False)
+
       # user wants to create a new directory
    def on_mkdir(self, name):
-      try:
-         self.board.mkdir(name)
-      except Exception as e:
-         self.show_exception(e)
+      self.board.mkdir(name, self.on_file_op_done)
 
    def on_delete(self, name):
       # close tab if present
       self.editors.close(name)
-      try:
-         self.board.rm(name)
-      except Exception as e:
-         self.show_exception(e)
+      self.board.rm(name, self.on_file_op_done)
          
    def on_example_saved(self, ctx = None):
       # the example has been saved. next check if there are additional
@@ -475,17 +471,39 @@ class Window(QMainWindow):
    def on_example_imported(self, name, code, ctx):
       self.on_save(name, code, True, self.on_example_saved, ctx)
 
-   def on_example_file_saved(self, ctx = None):
-      print("example file saved", ctx)
-      self.fileview.example_file_saved(ctx)
-      
    def on_example_file_imported(self, name, data, ctx):
-      # this is special as we might need to create parent
-      # directories while the example itself is just saved
-      # where the user wanted it to be
-      if self.mkpath(name):
-         self.fileview.add_file_entry(name, len(data))
-         self.on_save(name, data, not self.fileview.exists(name), self.on_example_file_saved, ctx, True )
+      # the example's extra files are collected and then written
+      # together. Continue with the next one
+      ctx.setdefault("written", [ ]).append( ( name, data ) )
+      self.fileview.example_file_saved(ctx)
+
+   def on_example_files_saved(self, success, results=None):
+      self.on_board_request(False)
+      self.console.set_button(True)
+      if success:
+         for op in self.example_ops:
+            if op[0] == "mkdir": self.fileview.add_dir_entry(op[1])
+            elif self.fileview.exists(op[1]): self.fileview.saved(op[1], len(op[2]))
+            else: self.fileview.add_file_entry(op[1], len(op[2]))
+         self.status(self.tr("Example files imported"))
+      else:
+         self.status(self.tr("Saving aborted with error"))
+      self.example_ops = None
+
+   def on_example_files_imported(self, ctx):
+      # write all extra files of an example and the directories they
+      # are in within a single raw repl session
+      files = ctx.pop("written", None)
+      if not files: return
+
+      names = [ name for name, data in files ]
+      self.example_ops = [ ("mkdir", d) for d in parent_dirs(names) if not self.fileview.exists(d) ]
+      self.example_ops += [ ("put", name, data.encode("utf-8") if isinstance(data, str) else data)
+                            for name, data in files ]
+
+      self.on_board_request(True)
+      self.console.set_button(None)
+      self.board.cmd(Board.BATCH, self.on_example_files_saved, self.example_ops)
       
    def on_example(self, name, ctx):
       # user has requested an example to be loaded
@@ -506,21 +524,14 @@ class Window(QMainWindow):
          self.on_message(self.tr("Import failed:") + "\n\n" + str(e))
       
    def on_rename(self, old, new):
-      try:
-         self.board.rename(old, new)
-         self.editors.rename(old, new)
-      except Exception as e:
-         self.show_exception(e)
-
-         # if the rename failed then the internal file tree may now be
-         # out of sync, so we reload it
-         self.select_file = old
-         self.board.cmd(Board.LISTDIR, self.on_rename_listdir)
-
-   def on_rename_listdir(self, success, files=None):
-      self.on_listdir(success, files)
-      # make source file visible again
-      self.fileview.select(self.select_file)
+      self.editors.rename(old, new)
+      self.board.rename(old, new, lambda success, result=None:
+                        self.on_renamed(old, new, success))
+
+   def on_renamed(self, old, new, success):
+      # if the rename failed the editor gets its old name back
+      if not success: self.editors.rename(new, old)
+      self.on_file_op_done(success)
       
    def on_message(self, msg):
       msgBox = QMessageBox(QMessageBox.Critical, self.tr("Error"), msg, parent=self)
@@ -552,6 +563,13 @@ class Window(QMainWindow):
          if not self.board.board: 
             self.start_rescan()
 
+   def on_deploy(self):
+      # the deployment talks to all boards itself. So the connection to
+      # the current one is closed meanwhile and searched again afterwards
+      self.board.close()
+      DeployDialog.deploy_dialog(self)
+      self.start_rescan()
+
    def mainWidget(self):
       self.vsplitter = QSplitter(Qt.Vertical)      
       self.hsplitter = QSplitter(Qt.Horizontal)
@@ -568,10 +586,15 @@ class Window(QMainWindow):
       self.fileview.example_import.connect(self.on_example)
       self.fileview.example_imported.connect(self.on_example_imported)
       self.fileview.example_file_imported.connect(self.on_example_file_imported)
+      self.fileview.example_files_imported.connect(self.on_example_files_imported)
       self.fileview.backup.connect(self.on_backup)
+      self.fileview.backup_incremental.connect(self.on_backup_incremental)
       self.fileview.restore.connect(self.on_restore)
       self.fileview.file_import.connect(self.on_file_import)
       self.fileview.file_export.connect(self.on_file_export)
+      self.fileview.fetch.connect(self.on_fetch)
+      self.fileview.sync.connect(self.on_sync)
+      self.fileview.deploy.connect(self.on_deploy)
       self.hsplitter.addWidget(self.fileview)
       self.hsplitter.setStretchFactor(0, 1)
       
@@ -591,6 +614,8 @@ class Window(QMainWindow):
       # the console is at the bottom
       self.console = Console()
       self.console.interact.connect(self.on_console_interact)
+      self.console.set_max_lines(self.settings.value('console_lines', Console.MAX_LINES, type=int))
+      self.console.set_log(self.settings.value('console_log', "", type=str))
       
       self.vsplitter.addWidget(self.console)
       self.vsplitter.setStretchFactor(1, 1)
@@ -642,6 +667,13 @@ class Window(QMainWindow):
          self.editors.on_select(self.settings.value('editor_current'))
          return
             
+      # the file may be in a directory which hasn't been listed yet
+      path = self.fileview.unlisted_dir(filelist[0])
+      if path is not None:
+         self.on_fetch(path, lambda success: self.open_next_file(filelist) if success
+                       else self.on_all_loaded())
+         return
+      
       # try to open first file in list
       size = self.fileview.get_file_size(filelist[0])
       if size == None:
@@ -649,7 +681,7 @@ class Window(QMainWindow):
          return
 
       self.board.cmd(Board.GET_FILE, self.on_loaded, { "name": filelist[0],
-                   "size": size, "filelist": filelist[1:], "quiet": True } )
+                   "size": size, "filelist": filelist[1:], "quiet": True, "cache": True } )
          
    def on_listdir(self, success, files=None):
       if success:
@@ -657,6 +689,33 @@ class Window(QMainWindow):
          
          # try to restore all previously open files
          self.open_next_file(self.settings.value('editor_open'))
+
+   def on_fetch(self, path, cb = None):
+      # list a single directory. The entries are added to the file view
+      # while they arrive
+      def on_fetched(success, entries=None):
+         self.fileview.fetched(path, success, entries)
+         if cb: cb(success)
+         else: self.progress(False)
+         
+      self.board.cmd(Board.LISTDIR, on_fetched, { "path": path })
+
+   def reload_files(self, restore_editors = True):
+      # list the top level files. This also re-enables the ui and, when
+      # connecting, reopens the files open in the last session
+      self.fileview.set([], False)
+      self.on_fetch("", self.on_root_listed if restore_editors
+                    else lambda success: self.on_all_loaded())
+
+      # directories listed before are listed again as well. The root
+      # listing's callback re-enables the ui
+      for path in self.fileview.listed_dirs():
+         if path: self.on_fetch(path, lambda success: None)
+      
+   def on_root_listed(self, success):
+      if success:
+         # try to restore all previously open files
+         self.open_next_file(self.settings.value('editor_open'))
       
    def on_version(self, success, version):
       # enable soft reset unless some LEGO device was detected. The reboot of the
@@ -673,10 +732,11 @@ class Window(QMainWindow):
       self.on_board_request(False)
       self.console.set_button(True)
 
-      # version received, request files
+      # version received, request the top level files. Directories
+      # are listed once they are being expanded
       self.on_board_request(True)
       self.console.set_button(None)
-      self.board.cmd(Board.LISTDIR, self.on_listdir)
+      self.reload_files()
 
    def on_retry_dialog_button(self, btn):
       if btn.text() == self.tr("Flash..."):
@@ -896,6 +956,12 @@ class Window(QMainWindow):
       self.lost_timer.timeout.connect(self.on_lost_timer)
       self.lost_timer.start(1000)
       
+   def port_reconnected(self, port):
+      # the board has been reset and is connected again. Open editors
+      # and the file view are kept
+      self.settings.setValue('port', port)
+      self.status(self.tr("Board reconnected at {}").format(port))
+
    def initUI(self):
       self.setWindowTitle("µPIDE - Micropython IDE")
 
@@ -919,8 +985,10 @@ class Window(QMainWindow):
       self.board.error.connect(self.on_error)
       self.board.status.connect(self.status)
       self.board.lost.connect(self.port_lost)
+      self.board.reconnected.connect(self.port_reconnected)
       self.board.interactive.connect(self.on_interactive)
       self.board.code_downloaded.connect(self.on_code_downloaded)
+      self.board.entries.connect(self.fileview.add_entries)
 
       # start scanning for board
       self.progress(False)